@@ -0,0 +1,405 @@
+"""Load test: drives bot.py end to end against a local fake Telegram Bot API.
+
+    python bench.py --items 2000 --admins 4 --latency-ms 30 --retry-after-rate 0.02 --out run.json
+    python bench.py --items 400 --targets 2 --latency-ms 500 --workers 2
+
+Synthetic media updates go through handle_media while the target workers run,
+so enqueue and dequeue overlap like a real burst. The fake API can add latency
+and answer copies with 429/RetryAfter. The JSON result (rates, DB ops and API
+calls per item, p50/p99 enqueue-to-post latency) can be compared between releases.
+`--workers N` also starts N `bot.py --worker` processes on the same database
+and fake API, configured like a copied .env.example, and reports duplicate
+posts and dead letters across processes.
+
+    python bench.py --ingest polling --items 5000 --album-ratio 0
+    python bench.py --ingest webhook --items 5000 --album-ratio 0 --senders 4
+
+`--ingest` only times how fast updates get in, with the queue paused: the fake
+API (in its own process) serves them to getUpdates, or `--senders` processes
+POST them to the webhook. It reports updates per second and the bot process's
+CPU time per update.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+import bench_env
+
+
+class FakeBotAPI:
+    """Answers Bot API methods the way Telegram would, just enough for bot.py."""
+
+    def __init__(self, latency_ms=0, jitter_ms=0, retry_after_rate=0.0, retry_after=1, updates=()):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.calls = {}
+        self.retry_afters = 0
+        # (user_id, message_id) -> perf_counter when each target's copy arrived
+        self.posted = {}
+        self.next_message_id = 1
+        # Served to getUpdates in order; update_ids run from 1
+        self.updates = list(updates)
+
+    def message(self, chat_id):
+        self.next_message_id += 1
+        return {"message_id": self.next_message_id, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": "ok"}
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+        if method.startswith("copyMessage") and random.random() < self.retry_after_rate:
+            self.retry_afters += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+
+        chat_id = int(data.get("chat_id", 0) or 0)
+        if method == "getMe":
+            result = {"id": 123, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "copyMessage":
+            self.record(int(data["from_chat_id"]), [int(data["message_id"])])
+            result = {"message_id": self.next_message_id}
+            self.next_message_id += 1
+        elif method == "copyMessages":
+            ids = data["message_ids"]
+            ids = json.loads(ids) if isinstance(ids, str) else ids
+            self.record(int(data["from_chat_id"]), ids)
+            result = [{"message_id": self.next_message_id + i} for i in range(len(ids))]
+            self.next_message_id += len(ids)
+        elif method in ("sendMessage", "editMessageText", "editMessageCaption"):
+            result = self.message(chat_id)
+        elif method == "getUpdates":
+            offset = max(1, int(data.get("offset", 0) or 0))
+            result = self.updates[offset - 1:offset - 1 + int(data.get("limit", 100) or 100)]
+        elif method == "getChat":
+            result = {"id": chat_id, "type": "private", "first_name": "Admin"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def record(self, user_id, message_ids):
+        now = time.perf_counter()
+        for message_id in message_ids:
+            self.posted.setdefault((user_id, int(message_id)), []).append(now)
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        return runner
+
+
+def serve_fake_api(port, latency_ms, updates, ready):
+    """Runs a FakeBotAPI in a process of its own, so its CPU isn't counted as the bot's."""
+    async def serve():
+        await FakeBotAPI(latency_ms, updates=updates).start(port)
+        ready.set()
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+
+def post_updates(url, secret, updates, start_at):
+    """POSTs `updates` to the webhook concurrently, starting at wall-clock `start_at`."""
+    import aiohttp
+
+    async def post_all():
+        bodies = [json.dumps(update) for update in updates]
+        headers = {"X-Telegram-Bot-Api-Secret-Token": secret, "Content-Type": "application/json"}
+        async with aiohttp.ClientSession() as session:
+            async def post(body):
+                async with session.post(url, data=body, headers=headers) as response:
+                    response.raise_for_status()
+            await asyncio.sleep(max(0, start_at - time.time()))
+            await asyncio.gather(*(post(body) for body in bodies))
+    asyncio.run(post_all())
+
+
+def make_updates(count, admins, album_ratio, seed):
+    """Synthetic private-chat video updates; roughly `album_ratio` of them arrive as 2-10 item albums."""
+    rng = random.Random(seed)
+    updates = []
+    message_id = 0
+    while len(updates) < count:
+        admin_id = 1000 + rng.randrange(admins)
+        size = rng.randint(2, 10) if rng.random() < album_ratio else 1
+        group_id = f"g{message_id}" if size > 1 else None
+        for _ in range(min(size, count - len(updates))):
+            message_id += 1
+            message = {
+                "message_id": message_id, "date": 0,
+                "chat": {"id": admin_id, "type": "private"},
+                "from": {"id": admin_id, "is_bot": False, "first_name": "Admin"},
+                "video": {"file_id": f"f{message_id}", "file_unique_id": f"u{message_id}",
+                          "width": 1, "height": 1, "duration": 1},
+            }
+            if group_id:
+                message["media_group_id"] = group_id
+            updates.append({"update_id": message_id, "message": message})
+    return updates
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def load_bot(args, **env):
+    """Points bot.py at a throwaway database and the fake API, then imports it."""
+    workdir = tempfile.mkdtemp(prefix="teleforwarder-bench-")
+    bench_env.configure(**{
+        "ADMIN_IDS": ",".join(str(1000 + i) for i in range(args.admins)),
+        "DB_NAME": os.path.join(workdir, "bench.db"),
+        "BOT_API_URL": f"http://127.0.0.1:{args.port}",
+        "PORT": "0",
+        **env,
+    })
+    import logging
+    logging.basicConfig(level=logging.CRITICAL, force=True)
+    import bot
+    return bot
+
+
+async def run_ingest(args):
+    payloads = make_updates(args.items, args.admins, args.album_ratio, args.seed)
+    bot = load_bot(args, PORT=str(args.port + 1))
+    spawn = multiprocessing.get_context("spawn")
+    polling = args.ingest == "polling"
+    ready = spawn.Event()
+    server = spawn.Process(target=serve_fake_api, args=(args.port, args.latency_ms, payloads if polling else [], ready))
+    server.start()
+    try:
+        if not await asyncio.to_thread(ready.wait, 30):
+            raise RuntimeError("fake Bot API did not start")
+        return await time_ingest(args, bot, payloads)
+    finally:
+        server.terminate()
+
+
+async def time_ingest(args, bot, payloads):
+    polling = args.ingest == "polling"
+    spawn = multiprocessing.get_context("spawn")
+    await bot.init_db()
+    await bot.update_settings({'paused': 1})
+    app = bot.build_application().build()
+    bot.add_handlers(app)
+    async with app:
+        await app.start()
+        # Give the senders time to start up; the clock runs from start_at
+        start_at = time.time() + 2
+        if polling:
+            await asyncio.sleep(start_at - time.time())
+        else:
+            receive = bot.webhook_route(bot.WEBHOOK_SECRET, lambda payload: bot.dispatch_update(app, payload), bot.WEBHOOK_MAX_INFLIGHT)
+            runner = await bot.start_server(bot.PORT, bot.metrics, bot.check_health, webhooks=[(bot.WEBHOOK_PATH, receive)])
+            url = f"http://127.0.0.1:{bot.PORT}{bot.WEBHOOK_PATH}"
+            senders = [
+                spawn.Process(target=post_updates, args=(url, bot.WEBHOOK_SECRET, payloads[i::args.senders], start_at))
+                for i in range(args.senders)
+            ]
+            for sender in senders:
+                sender.start()
+            await asyncio.sleep(max(0, start_at - time.time()))
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        if polling:
+            await app.updater.start_polling(poll_interval=0, timeout=0)
+
+        deadline = started + args.timeout
+        while bot.ingest.pending < args.items and time.perf_counter() < deadline:
+            await asyncio.sleep(0.005)
+        seconds = time.perf_counter() - started
+        cpu = time.process_time() - cpu_started
+        received = bot.ingest.pending
+
+        if polling:
+            await app.updater.stop()
+        else:
+            for sender in senders:
+                await asyncio.to_thread(sender.join, 10)
+                sender.terminate()
+            await runner.cleanup()
+        await app.stop()
+    await bot.ingest.flush()
+    await bot.db.close()
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("out", "port")},
+        "items": args.items,
+        "timed_out": received < args.items,
+        "updates_received": received,
+        "seconds": round(seconds, 3),
+        "updates_per_s": round(received / seconds),
+        "bot_cpu_us_per_update": round(cpu / max(1, received) * 1e6),
+    }
+
+
+async def run(args):
+    bot = load_bot(
+        args,
+        MAX_SEND_RATE=str(args.send_rate),
+        SEND_BURST=str(max(1, int(args.send_rate))),
+        RETRY_BASE="0.5",
+        # What python-dotenv loads from a copied .env.example; every process must still get its own id
+        WORKER_ID="",
+        WORKER_PORT="0",
+    )
+    from telegram import Update
+
+    fake = FakeBotAPI(args.latency_ms, args.jitter_ms, args.retry_after_rate, args.retry_after)
+    server = await fake.start(args.port)
+
+    await bot.init_db()
+    if args.captions:
+        await bot.update_settings({'delay': 1, 'total_off': 0, 'custom_text': 'Bench caption', 'custom_remaining': -1})
+    else:
+        await bot.update_settings({'delay': 1, 'total_off': 1})
+    for i in range(1, args.targets):
+        await bot.add_target(-1000000000001 - i, f"Target {i + 1}")
+    app = bot.build_application().build()
+    await app.initialize()
+    context = type("Context", (), {"bot": app.bot, "args": []})()
+    updates = [Update.de_json(payload, app.bot) for payload in make_updates(args.items, args.admins, args.album_ratio, args.seed)]
+
+    for series in (bot.db_latency.values, bot.send_latency.values):
+        series.clear()
+    tasks = [
+        asyncio.create_task(bot.queue_processor(app)),
+        asyncio.create_task(bot.cleanup_queue.run(app.bot)),
+        asyncio.create_task(bot.stats_flush_worker()),
+        asyncio.create_task(bot.timers.run()),
+    ]
+    if args.workers:
+        # Items the workers post only leave our counters when we reload them
+        tasks.append(asyncio.create_task(bot.sync_worker(app, 0.5)))
+    enqueued_at = {}
+    started = time.perf_counter()
+    for update in updates:
+        enqueued_at[(update.effective_user.id, update.message.message_id)] = time.perf_counter()
+        await bot.handle_media(update, context)
+    await bot.ingest.flush()
+    enqueue_seconds = time.perf_counter() - started
+    # Workers join mid-drain, while this process has sends in flight, like scaling out during a backlog
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    workers = [
+        subprocess.Popen([sys.executable, script, "--worker"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for _ in range(args.workers)
+    ]
+
+    deadline = time.perf_counter() + args.timeout
+    while bot.ingest.pending and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    total_seconds = time.perf_counter() - started
+    timed_out = bot.ingest.pending > 0
+
+    for task in tasks:
+        task.cancel()
+    for worker in workers:
+        worker.terminate()
+        worker.wait()
+    for chat_id in list(bot.target_tasks):
+        bot.stop_target_worker(chat_id)
+    await asyncio.sleep(0)
+    await bot.stats_buffer.flush()
+
+    latencies = []
+    for key, times in fake.posted.items():
+        if key in enqueued_at:
+            latencies.extend((t - enqueued_at[key]) * 1000 for t in times)
+    posts = sum(len(times) for times in fake.posted.values())
+    api_calls = sum(fake.calls.values())
+    db_ops = sum(series[2] for series in bot.db_latency.values.values())
+    first_post = min((t for times in fake.posted.values() for t in times), default=started)
+    last_post = max((t for times in fake.posted.values() for t in times), default=started)
+    items = len(updates)
+    dead_letters = (await bot.db.fetchone("SELECT COUNT(*) FROM dead_letters"))[0]
+    result = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("out", "port")},
+        "items": items,
+        "timed_out": timed_out,
+        "enqueue_seconds": round(enqueue_seconds, 3),
+        "total_seconds": round(total_seconds, 3),
+        "enqueue_rate": round(items / enqueue_seconds, 1) if enqueue_seconds else None,
+        "dequeue_rate": round(posts / args.targets / (last_post - first_post), 1) if last_post > first_post else None,
+        "db_ops_per_item": round(db_ops / items, 2),
+        "api_calls_per_item": round(api_calls / items, 3),
+        "copy_calls_per_item": round(sum(n for m, n in fake.calls.items() if m.startswith("copyMessage")) / items, 3),
+        "api_calls": dict(sorted(fake.calls.items())),
+        "retry_afters": fake.retry_afters,
+        "posts": posts,
+        "duplicate_posts": sum(len(times) - args.targets for times in fake.posted.values() if len(times) > args.targets),
+        "dead_letters": dead_letters,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 1) if latencies else None,
+            "p99": round(percentile(latencies, 99), 1) if latencies else None,
+            "max": round(max(latencies), 1) if latencies else None,
+        },
+    }
+
+    await app.shutdown()
+    await bot.db.close()
+    await server.cleanup()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=2000)
+    parser.add_argument("--admins", type=int, default=4)
+    parser.add_argument("--targets", type=int, default=1)
+    parser.add_argument("--album-ratio", type=float, default=0.2, help="share of uploads sent as albums")
+    parser.add_argument("--captions", action="store_true", help="captions on (one post per call) instead of clean bulk mode")
+    parser.add_argument("--latency-ms", type=float, default=0, help="added to every fake API call")
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="chance a copy call gets a 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after seconds in injected 429s")
+    parser.add_argument("--send-rate", type=float, default=1000, help="MAX_SEND_RATE per target")
+    parser.add_argument("--workers", type=int, default=0, help="extra `bot.py --worker` processes sharing the queue")
+    parser.add_argument("--ingest", choices=("polling", "webhook"), help="only time update ingestion this way")
+    parser.add_argument("--senders", type=int, default=4, help="webhook POST processes (--ingest webhook)")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=18181, help="port for the fake Bot API")
+    parser.add_argument("--out", help="write the JSON result here as well as to stdout")
+    args = parser.parse_args()
+
+    result = asyncio.run(run_ingest(args) if args.ingest else run(args))
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    # Background tasks in bot.py never finish on their own
+    os._exit(1 if result["timed_out"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""Microbenchmark: queue database paths, without Telegram.
+
+    python bench_db.py ops --items 2000
+    python bench_db.py ops-baseline --items 2000
+    python bench_db.py burst --items 10000
+    python bench_db.py burst-baseline --items 10000
+    python bench_db.py history --history 1000000
+
+Modes:
+
+- ops: enqueue (add_to_queue + group commit) and dequeue (pick, claim, journal,
+  ack) rates for one admin and one target, in items per second
+- ops-baseline: the same loop through the original helpers (a new connection,
+  commit and default rollback journal per call; get_next_item + mark_as_sent),
+  replayed here so the shared-connection numbers have something to compare to
+- burst: a burst of media updates through handle_media, including the final
+  group commit, in updates per second
+- burst-baseline: the same burst through the enqueue path before group commit
+  (a committed INSERT plus COUNT(*) per update on the shared connection, and a
+  summary task cancelled and recreated per update)
+- history: seeds finished rows (sent/cancelled three days ago) next to a small
+  pending backlog, then times startup, the worker's fetch, the admin summary
+  and the queue lag, archives the old rows and times them again
+
+Each run uses a fresh database in a temporary directory and prints JSON.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import aiosqlite
+
+import bench_env
+
+
+class NullBot:
+    """Stands in for telegram.Bot where complete_items posts progress messages."""
+
+    async def send_message(self, **kwargs):
+        return SimpleNamespace(message_id=1)
+
+    async def edit_message_text(self, **kwargs):
+        return None
+
+
+async def bench_ops(bot, args):
+    await bot.init_db()
+    started = time.perf_counter()
+    for i in range(args.items):
+        await bot.add_to_queue(1, i + 1, "Video")
+    await bot.ingest.flush()
+    enqueue = time.perf_counter() - started
+
+    chat_id = next(iter(bot.targets))
+    null_bot = NullBot()
+    posted = units = 0
+    started = time.perf_counter()
+    while True:
+        rows = await bot.get_next_run(chat_id)
+        if not rows:
+            break
+        unit = bot.next_unit(await bot.assign_captions(rows))
+        queue_ids = [row['id'] for row in unit]
+        if not await bot.claim_unit(chat_id, queue_ids):
+            continue
+        bot.scheduler.charge(chat_id)
+        done = await bot.record_deliveries(chat_id, queue_ids, 'sent')
+        await bot.complete_items(null_bot, done)
+        posted += len(done)
+        units += 1
+    dequeue = time.perf_counter() - started
+    return {
+        "enqueue_ops_per_s": round(args.items / enqueue),
+        "dequeue_ops_per_s": round(posted / dequeue),
+        "items_posted": posted,
+        "api_units": units,
+    }
+
+
+# The queue table and helpers as they were before the shared connection
+BASELINE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        message_id INTEGER,
+        media_type TEXT,
+        status TEXT DEFAULT 'pending',
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+
+async def baseline_add_to_queue(path, user_id, message_id, media_type):
+    async with aiosqlite.connect(path) as db:
+        await db.execute(
+            "INSERT INTO queue (user_id, message_id, media_type) VALUES (?, ?, ?)",
+            (user_id, message_id, media_type)
+        )
+        await db.commit()
+        async with db.execute("SELECT COUNT(*) FROM queue WHERE status='pending'") as cursor:
+            return (await cursor.fetchone())[0]
+
+
+async def baseline_get_next_item(path):
+    async with aiosqlite.connect(path) as db:
+        db.row_factory = aiosqlite.Row
+        async with db.execute("SELECT * FROM queue WHERE status='pending' ORDER BY id ASC LIMIT 1") as cursor:
+            return await cursor.fetchone()
+
+
+async def baseline_mark_as_sent(path, queue_id):
+    async with aiosqlite.connect(path) as db:
+        await db.execute("UPDATE queue SET status='sent' WHERE id = ?", (queue_id,))
+        await db.commit()
+
+
+async def bench_ops_baseline(bot, args):
+    path = os.environ["DB_NAME"]
+    conn = sqlite3.connect(path)
+    conn.execute(BASELINE_SCHEMA)
+    conn.close()
+    started = time.perf_counter()
+    for i in range(args.items):
+        await baseline_add_to_queue(path, 1, i + 1, "Video")
+    enqueue = time.perf_counter() - started
+
+    started = time.perf_counter()
+    posted = 0
+    while True:
+        item = await baseline_get_next_item(path)
+        if item is None:
+            break
+        await baseline_mark_as_sent(path, item['id'])
+        posted += 1
+    dequeue = time.perf_counter() - started
+    return {
+        "enqueue_ops_per_s": round(args.items / enqueue),
+        "dequeue_ops_per_s": round(posted / dequeue),
+        "items_posted": posted,
+        "api_units": posted,
+    }
+
+
+async def reply_text(*args, **kwargs):
+    return None
+
+
+def media_update(user_id, message_id):
+    video = SimpleNamespace(file_unique_id=f"bench-{user_id}-{message_id}")
+    message = SimpleNamespace(
+        text=None, video=video, photo=None, animation=None, document=None,
+        message_id=message_id, media_group_id=None, reply_text=reply_text,
+    )
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), message=message)
+
+
+async def bench_burst(bot, args):
+    await bot.init_db()
+    updates = [media_update(1 + i % 2, i + 1) for i in range(args.items)]
+    started = time.perf_counter()
+    for update in updates:
+        await bot.handle_media(update, None)
+    await bot.ingest.flush()
+    elapsed = time.perf_counter() - started
+    rows = (await bot.db.fetchone("SELECT COUNT(*) FROM queue"))[0]
+    return {
+        "updates_per_s": round(args.items / elapsed),
+        "us_per_update": round(elapsed / args.items * 1e6, 1),
+        "rows_queued": rows,
+    }
+
+
+async def bench_burst_baseline(bot, args):
+    await bot.init_db()
+    updates = [media_update(1 + i % 2, i + 1) for i in range(args.items)]
+    summaries = {}
+    started = time.perf_counter()
+    for update in updates:
+        msg = update.message
+        await bot.db.execute(
+            "INSERT INTO queue (user_id, message_id, media_type, media_group_id) VALUES (?, ?, ?, ?)",
+            (update.effective_user.id, msg.message_id, "Video", msg.media_group_id)
+        )
+        await bot.db.fetchone("SELECT COUNT(*) FROM queue WHERE status='pending'")
+        task = summaries.get(update.effective_user.id)
+        if task:
+            task.cancel()
+        summaries[update.effective_user.id] = asyncio.create_task(asyncio.sleep(3))
+    elapsed = time.perf_counter() - started
+    for task in summaries.values():
+        task.cancel()
+    rows = (await bot.db.fetchone("SELECT COUNT(*) FROM queue"))[0]
+    return {
+        "updates_per_s": round(args.items / elapsed),
+        "us_per_update": round(elapsed / args.items * 1e6, 1),
+        "rows_queued": rows,
+    }
+
+
+async def per_call_ms(fn, reps=50):
+    started = time.perf_counter()
+    for _ in range(reps):
+        await fn()
+    return round((time.perf_counter() - started) / reps * 1000, 3)
+
+
+async def time_reads(bot):
+    chat_id = next(iter(bot.targets))
+    return {
+        "get_next_run_ms": await per_call_ms(lambda: bot.get_next_run(chat_id)),
+        "get_admin_summary_ms": await per_call_ms(lambda: bot.get_admin_summary([1, 2])),
+        "get_queue_lag_ms": await per_call_ms(bot.get_queue_lag),
+    }
+
+
+async def bench_history(bot, args):
+    await bot.init_db()
+    await bot.db.close()
+    # Bulk-load through plain sqlite3; going through the bot would take minutes
+    conn = sqlite3.connect(os.environ["DB_NAME"])
+    conn.executemany(
+        "INSERT INTO queue (user_id, message_id, media_type, status, timestamp, finished_at) "
+        "VALUES (?, ?, 'Video', ?, datetime('now', '-3 days'), datetime('now', '-3 days'))",
+        ((1 + i % 2, i + 1, 'sent' if i % 10 else 'cancelled') for i in range(args.history))
+    )
+    conn.executemany(
+        "INSERT INTO queue (user_id, message_id, media_type) VALUES (3, ?, 'Video')",
+        ((i + 1,) for i in range(args.items))
+    )
+    conn.commit()
+    conn.close()
+
+    started = time.perf_counter()
+    await bot.init_db()
+    result = {"init_db_ms": round((time.perf_counter() - started) * 1000)}
+    result["before_archive"] = await time_reads(bot)
+    started = time.perf_counter()
+    result["archived_rows"] = await bot.archive_finished_rows(24)
+    result["archive_s"] = round(time.perf_counter() - started, 1)
+    result["after_archive"] = await time_reads(bot)
+    return result
+
+
+MODES = {
+    "ops": bench_ops,
+    "ops-baseline": bench_ops_baseline,
+    "burst": bench_burst,
+    "burst-baseline": bench_burst_baseline,
+    "history": bench_history,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("mode", choices=sorted(MODES))
+    parser.add_argument("--items", type=int, default=2000, help="items to enqueue (history: pending backlog)")
+    parser.add_argument("--history", type=int, default=1_000_000, help="finished rows to seed (history mode)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="teleforwarder-bench-db-")
+    bench_env.configure(DB_NAME=os.path.join(workdir, "bench.db"))
+    logging.disable(logging.CRITICAL)
+    import bot
+
+    result = {"mode": args.mode, "config": vars(args), "results": asyncio.run(MODES[args.mode](bot, args))}
+    print(json.dumps(result, indent=2))
+    # Skip the interpreter's teardown of aiosqlite's worker thread
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
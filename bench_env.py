@@ -0,0 +1,25 @@
+"""Shared setup for the bench_*.py scripts.
+
+bot.py reads its config on import, so every benchmark sets up the environment
+with configure() before the first `import bot`.
+"""
+import os
+import sys
+
+DEFAULTS = {
+    "BOT_TOKEN": "123:bench",
+    "TARGET_GROUP_ID": "-1000000000001",
+    "ADMIN_IDS": "1,2,3",
+}
+
+
+def configure(**env):
+    """Sets `env`, fills in the minimum bot.py needs to start and makes it importable.
+
+    Nothing set here points at Telegram; a benchmark that touches the network or
+    the database passes its own BOT_API_URL or DB_NAME.
+    """
+    os.environ.update(env)
+    for key, value in DEFAULTS.items():
+        os.environ.setdefault(key, value)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
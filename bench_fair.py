@@ -0,0 +1,93 @@
+"""Simulation: how long small submitters wait behind one big upload.
+
+    python bench_fair.py --big 2000 --small 4 --small-items 5 --send-every 10
+
+One admin dumps `--big` items at t=0; each small admin sends `--small-items`
+items later on (at the `--arrivals` offsets, in seconds). One item goes out
+every `--send-every` seconds. Compares:
+
+- fifo: items go out strictly in arrival order, as before the fair scheduler
+- wrr:  bot.FairScheduler (smooth weighted round-robin between admins)
+
+Reports p50/p99/max wait of the small admins' items and when the big upload
+finishes, in minutes. No database or network is involved.
+"""
+import argparse
+import json
+import statistics
+from collections import deque
+
+import bench_env
+
+
+def arrivals(args):
+    """[(arrival time, user_id)] in arrival order; user 1 is the big submitter."""
+    items = [(0, 1)] * args.big
+    for n, offset in enumerate(args.arrivals[:args.small]):
+        items += [(offset, n + 2)] * args.small_items
+    return sorted(items, key=lambda item: item[0])
+
+
+def simulate(bot, args, fair):
+    items = arrivals(args)
+    scheduler = bot.FairScheduler({1: args.big_weight})
+    fifo = deque()
+    per_user = {}
+    waits = {}
+    now = 0
+    arrived = 0
+    while sum(len(w) for w in waits.values()) < len(items):
+        while arrived < len(items) and items[arrived][0] <= now:
+            at, user_id = items[arrived]
+            fifo.append((at, user_id))
+            per_user.setdefault(user_id, deque()).append(at)
+            scheduler.add(user_id, 0)
+            arrived += 1
+        if fair:
+            pick = scheduler.pick(0)
+            if pick:
+                scheduler.charge(0)
+                user_id = pick[1]
+                at = per_user[user_id].popleft()
+                fifo.remove((at, user_id))
+        else:
+            pick = fifo[0] if fifo else None
+            if pick:
+                at, user_id = fifo.popleft()
+                per_user[user_id].popleft()
+        if pick:
+            scheduler.remove(user_id, 0)
+            waits.setdefault(user_id, []).append(now - at)
+        now += args.send_every
+    small = sorted(wait for user_id, w in waits.items() if user_id != 1 for wait in w)
+    return {
+        "small_p50_min": round(statistics.median(small) / 60, 1),
+        "small_p99_min": round(small[max(0, int(len(small) * 0.99) - 1)] / 60, 1),
+        "small_max_min": round(small[-1] / 60, 1),
+        "big_done_min": round(max(waits[1]) / 60, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--big", type=int, default=2000, help="items the big admin sends at t=0")
+    parser.add_argument("--big-weight", type=int, default=1, help="ADMIN_WEIGHTS entry for the big admin")
+    parser.add_argument("--small", type=int, default=4, help="number of small admins")
+    parser.add_argument("--small-items", type=int, default=5)
+    parser.add_argument("--arrivals", type=int, nargs="+", default=[60, 300, 900, 3000],
+                        help="seconds after t=0 each small admin sends their items")
+    parser.add_argument("--send-every", type=int, default=10, help="seconds between posts")
+    args = parser.parse_args()
+
+    bench_env.configure()
+    import bot
+
+    result = {
+        "config": vars(args),
+        "results": {"fifo": simulate(bot, args, False), "wrr": simulate(bot, args, True)},
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
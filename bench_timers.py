@@ -0,0 +1,171 @@
+"""Microbenchmark: debounce/expiry timers for the batch summary and saved captions.
+
+    python bench_timers.py --admins 8 --burst 1000 --rounds 3
+
+Compares the tasks created and peak memory of three ways to debounce each
+admin's batch summary (and expire an unused caption):
+
+- task_per_update: cancel the admin's sleeping task and start a new one per update
+- task_per_burst:  one sleeping task per burst that re-checks a pushed-back deadline
+- scheduler:       bot.DeadlineScheduler, one coroutine over a heap of deadlines
+"""
+import argparse
+import asyncio
+import json
+import time
+import tracemalloc
+
+import bench_env
+
+
+class TaskPerUpdate:
+    """Cancel-and-recreate per update; captions stay in the dict until used."""
+
+    def __init__(self, quiet):
+        self.quiet = quiet
+        self.tasks = {}
+        self.captions = {}
+        self.fired = 0
+
+    async def fire(self, user_id):
+        try:
+            await asyncio.sleep(self.quiet)
+            self.fired += 1
+            del self.tasks[user_id]
+        except asyncio.CancelledError:
+            pass
+
+    def note(self, user_id):
+        if user_id in self.tasks:
+            self.tasks[user_id].cancel()
+        self.tasks[user_id] = asyncio.create_task(self.fire(user_id))
+
+    def caption(self, user_id):
+        self.captions[user_id] = {"text": "caption", "time": time.monotonic()}
+
+    def live(self):
+        return len(self.tasks) + len(self.captions)
+
+    async def start(self):
+        pass
+
+
+class TaskPerBurst(TaskPerUpdate):
+    """One sleeping task per burst; each update only moves the deadline."""
+
+    async def fire(self, user_id):
+        while True:
+            remaining = self.tasks[user_id]["deadline"] - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+        self.fired += 1
+        del self.tasks[user_id]
+
+    def note(self, user_id):
+        if user_id in self.tasks:
+            self.tasks[user_id]["deadline"] = time.monotonic() + self.quiet
+        else:
+            self.tasks[user_id] = {"deadline": time.monotonic() + self.quiet}
+            self.tasks[user_id]["task"] = asyncio.create_task(self.fire(user_id))
+
+
+class Scheduler(TaskPerUpdate):
+    def __init__(self, quiet):
+        super().__init__(quiet)
+        import bot
+        self.timers = bot.DeadlineScheduler()
+
+    async def fire(self, user_id):
+        self.fired += 1
+
+    async def expire(self, user_id):
+        self.captions.pop(user_id, None)
+
+    def note(self, user_id):
+        self.timers.schedule(("batch", user_id), self.quiet, self.fire, user_id)
+
+    def caption(self, user_id):
+        super().caption(user_id)
+        self.timers.schedule(("caption", user_id), self.quiet, self.expire, user_id)
+
+    def live(self):
+        return len(self.timers.deadlines) + len(self.captions)
+
+    async def start(self):
+        self.runner = asyncio.create_task(self.timers.run())
+
+
+async def drive(strategy, args):
+    """Feeds `rounds` interleaved bursts, waiting out the quiet period after each; returns feed time."""
+    elapsed = 0.0
+    for _ in range(args.rounds):
+        started = time.perf_counter()
+        for i in range(args.burst):
+            for user_id in range(args.admins):
+                if i == 0:
+                    strategy.caption(user_id)
+                strategy.note(user_id)
+            if i % 50 == 0:
+                # Let the loop run, as it would between real updates
+                await asyncio.sleep(0)
+        elapsed += time.perf_counter() - started
+        await asyncio.sleep(args.quiet * 2)
+    return elapsed
+
+
+async def measure(strategy_cls, args):
+    loop = asyncio.get_running_loop()
+    created = [0]
+
+    def count_tasks(loop, coro, **kwargs):
+        created[0] += 1
+        return asyncio.Task(coro, loop=loop, **kwargs)
+
+    # Timing pass first: tracemalloc would slow the allocation-heavy strategies down
+    strategy = strategy_cls(args.quiet)
+    await strategy.start()
+    loop.set_task_factory(count_tasks)
+    elapsed = await drive(strategy, args)
+    loop.set_task_factory(None)
+
+    strategy = strategy_cls(args.quiet)
+    await strategy.start()
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    await drive(strategy, args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    updates = args.rounds * args.burst * args.admins
+    return {
+        "tasks_created": created[0],
+        "tasks_per_update": round(created[0] / updates, 4),
+        "us_per_update": round(elapsed / updates * 1e6, 2),
+        "peak_kib": round((peak - base) / 1024, 1),
+        "summaries_sent": strategy.fired,
+        "entries_left_after_quiet": strategy.live(),
+    }
+
+
+async def run(args):
+    results = {}
+    for name, cls in (("task_per_update", TaskPerUpdate), ("task_per_burst", TaskPerBurst), ("scheduler", Scheduler)):
+        results[name] = await measure(cls, args)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--admins", type=int, default=8)
+    parser.add_argument("--burst", type=int, default=1000, help="updates per admin per burst")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--quiet", type=float, default=0.2, help="debounce/expiry delay in seconds")
+    args = parser.parse_args()
+
+    bench_env.configure()
+    result = {"config": vars(args), "results": asyncio.run(run(args))}
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
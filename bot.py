@@ -1,12 +1,21 @@
-from web import keep_alive
-keep_alive()
 import logging
 import asyncio
+import html
 import os
 import sys
+import time
+import random
+import socket
+import hashlib
+import heapq
+import cProfile
+import pstats
+import tracemalloc
 import aiosqlite
 import pytz
-from datetime import date, datetime, timedelta
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from datetime import date, datetime, timedelta, timezone
 from dotenv import load_dotenv
 
 from telegram import Update
@@ -18,7 +27,9 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
-from telegram.error import TelegramError, RetryAfter
+from telegram.error import TelegramError, RetryAfter, BadRequest, Forbidden
+
+from web import MetricsRegistry, Timer, start_server, webhook_route
 
 # ================= CONFIGURATION =================
 # Load environment variables
@@ -36,6 +47,17 @@ except ValueError:
     print("❌ Error: ADMIN_IDS in .env must be a comma-separated list of integers.")
     sys.exit(1)
 
+# Optional scheduling weights, e.g. "12345678:3,87654321:1" (default weight is 1)
+admin_weights_str = os.getenv("ADMIN_WEIGHTS", "")
+try:
+    ADMIN_WEIGHTS = {
+        int(uid): int(weight)
+        for uid, weight in (x.strip().split(":") for x in admin_weights_str.split(",") if x.strip())
+    }
+except ValueError:
+    print("❌ Error: ADMIN_WEIGHTS in .env must look like 12345678:3,87654321:1")
+    sys.exit(1)
+
 # Validate Critical Config
 if not BOT_TOKEN or not TARGET_GROUP_ID:
     print("❌ Error: BOT_TOKEN and TARGET_GROUP_ID must be set in .env file.")
@@ -43,6 +65,97 @@ if not BOT_TOKEN or not TARGET_GROUP_ID:
 
 TARGET_GROUP_ID = int(TARGET_GROUP_ID)
 
+# Several processes (and several bot tokens) may share one DB. Items are tagged
+# with the id of the bot that received them, since only that bot can copy them
+# out of the admin's private chat; leases keep processes off each other's sends.
+BOT_ID = int(BOT_TOKEN.split(":")[0]) if BOT_TOKEN.split(":")[0].isdigit() else 0
+# `or`, not a getenv default: a copied .env with an empty WORKER_ID= would give
+# every process the same id, and each would reap the others' sends as its own
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+LEASE_SECONDS = int(os.getenv("LEASE_SECONDS", "120"))
+# Optional Bot API server, e.g. a local fake for load tests
+BOT_API_URL = os.getenv("BOT_API_URL")
+# Seconds between re-reading shared state written by other processes (0 = off; workers default to 2)
+SYNC_INTERVAL = float(os.getenv("SYNC_INTERVAL", "0"))
+
+# Timezone used when showing timestamps to admins
+try:
+    DISPLAY_TZ = pytz.timezone(os.getenv("DISPLAY_TIMEZONE", "Asia/Dhaka"))
+except pytz.UnknownTimeZoneError:
+    print("❌ Error: DISPLAY_TIMEZONE in .env must be a valid tz name (e.g. Asia/Dhaka).")
+    sys.exit(1)
+
+# Send-rate scheduler: upper bound (messages/second) and burst size per target chat
+MAX_SEND_RATE = float(os.getenv("MAX_SEND_RATE", "1"))
+SEND_BURST = int(os.getenv("SEND_BURST", "3"))
+
+# Minimum seconds between edits of an admin's live progress message
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "5"))
+
+# Incoming media is written to the queue in one transaction every few ms or N rows
+INGEST_FLUSH_MS = int(os.getenv("INGEST_FLUSH_MS", "50"))
+INGEST_FLUSH_ROWS = int(os.getenv("INGEST_FLUSH_ROWS", "500"))
+
+# Rows sent/cancelled longer ago than this move to queue_archive; the check runs every interval
+ARCHIVE_AFTER_HOURS = int(os.getenv("ARCHIVE_AFTER_HOURS", "24"))
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", "3600"))
+
+# Seconds between flushes of the in-memory send counters to the stats tables
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "5"))
+
+# Seconds an admin's cached name/username stays fresh
+PROFILE_TTL = int(os.getenv("PROFILE_TTL", "3600"))
+
+# Failed sends are retried with exponential backoff (RETRY_BASE, doubling, capped at
+# RETRY_MAX seconds); after MAX_ATTEMPTS they go to the dead-letter table
+MAX_ATTEMPTS = int(os.getenv("MAX_ATTEMPTS", "5"))
+RETRY_BASE = float(os.getenv("RETRY_BASE", "30"))
+RETRY_MAX = float(os.getenv("RETRY_MAX", "3600"))
+
+# A send cut off by a crash may or may not have been posted. 'hold' files it under
+# /failed for someone to check; 'resend' sends it again (possibly a duplicate).
+RECOVERY_MODE = os.getenv("RECOVERY_MODE", "hold")
+
+# /healthz and /metrics are served on this port (0 = off). Worker processes use
+# WORKER_PORT instead so they don't clash with the main bot on one host.
+PORT = int(os.getenv("PORT", "8080"))
+WORKER_PORT = int(os.getenv("WORKER_PORT", "0"))
+# A target worker that hasn't looped for this long (plus the current delay) while
+# items are pending counts as stalled; MAX_QUEUE_LAG (0 = off) fails on old backlog
+HEALTH_STALL_SECONDS = int(os.getenv("HEALTH_STALL_SECONDS", "300"))
+MAX_QUEUE_LAG = int(os.getenv("MAX_QUEUE_LAG", "0"))
+
+# Pending-item quotas checked on every upload (0 = no limit). When full, uploads are
+# 'reject'ed or 'spill'ed to an overflow table that is promoted as items go out
+# (MAX_OVERFLOW caps the overflow, 0 = no limit)
+MAX_PENDING = int(os.getenv("MAX_PENDING", "0"))
+MAX_PENDING_PER_ADMIN = int(os.getenv("MAX_PENDING_PER_ADMIN", "0"))
+OVERFLOW_MODE = os.getenv("OVERFLOW_MODE", "spill")
+MAX_OVERFLOW = int(os.getenv("MAX_OVERFLOW", "0"))
+if OVERFLOW_MODE not in ("reject", "spill"):
+    print("❌ Error: OVERFLOW_MODE in .env must be 'reject' or 'spill'.")
+    sys.exit(1)
+
+# /perf keeps this many recent timings per stage; /perf cpu|mem writes reports to PERF_DIR
+PERF_SAMPLES = int(os.getenv("PERF_SAMPLES", "2048"))
+PERF_DIR = os.getenv("PERF_DIR", ".")
+
+# UPDATE_MODE=webhook receives updates on PORT at WEBHOOK_PATH instead of long polling.
+# WEBHOOK_URL (public https base) registers the webhook with Telegram; leave it empty
+# to test locally by POSTing update JSON yourself.
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+# Defaults to a value derived from the token, so it survives restarts without setup
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+WEBHOOK_MAX_INFLIGHT = int(os.getenv("WEBHOOK_MAX_INFLIGHT", "64"))
+if UPDATE_MODE not in ("polling", "webhook"):
+    print("❌ Error: UPDATE_MODE in .env must be 'polling' or 'webhook'.")
+    sys.exit(1)
+if UPDATE_MODE == "webhook" and not PORT:
+    print("❌ Error: UPDATE_MODE=webhook needs PORT set in .env file.")
+    sys.exit(1)
+
 # ================= LOGGING =================
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -50,14 +163,767 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Global Dictionary to store temporary captions
+# ================= METRICS =================
+metrics = MetricsRegistry()
+queue_depth = metrics.gauge("teleforwarder_queue_depth", "Items waiting to be sent")
+queue_lag = metrics.gauge("teleforwarder_queue_lag_seconds", "Age of the oldest pending item")
+retrying_gauge = metrics.gauge("teleforwarder_retrying", "Deliveries waiting for a retry")
+dead_letters_gauge = metrics.gauge("teleforwarder_dead_letters", "Sends listed in /failed")
+overflow_depth = metrics.gauge("teleforwarder_overflow_items", "Uploads spilled to the overflow table")
+rejected_total = metrics.counter("teleforwarder_rejected_total", "Uploads turned away because the queue was full")
+items_per_minute = metrics.gauge("teleforwarder_items_per_minute", "Items completed in the last 60 seconds")
+heartbeat_age = metrics.gauge("teleforwarder_worker_heartbeat_age_seconds", "Seconds since each target worker last looped")
+items_sent = metrics.counter("teleforwarder_items_sent_total", "Items delivered to at least one target")
+retry_after_total = metrics.counter("teleforwarder_retry_after_total", "RetryAfter (flood limit) responses")
+send_errors = metrics.counter("teleforwarder_send_errors_total", "Failed sends by outcome (retry or dead)")
+send_latency = metrics.histogram(
+    "teleforwarder_send_seconds", "Bot API latency of one post (single, album or bulk run)",
+    (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+db_latency = metrics.histogram(
+    "teleforwarder_db_seconds", "SQLite call latency, including the wait for the write lock",
+    (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+)
+
+class PerfSpans:
+    """Rolling per-stage timings for /perf: the last `samples` durations of each stage."""
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.capturing = None
+        self.reset()
+
+    def reset(self):
+        self.durations = {}
+        self.calls = {}
+        self.items = 0
+        self.since = time.monotonic()
+
+    @contextmanager
+    def span(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started)
+
+    def add(self, stage, seconds):
+        ring = self.durations.get(stage)
+        if ring is None:
+            ring = self.durations[stage] = deque(maxlen=self.samples)
+        ring.append(seconds)
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def summary(self):
+        """[(stage, p50, p95, p99, calls)] with times in ms, highest p95 first."""
+        rows = []
+        for stage, ring in self.durations.items():
+            ordered = sorted(ring)
+            pick = lambda p: ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000
+            rows.append((stage, pick(0.50), pick(0.95), pick(0.99), self.calls[stage]))
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    async def capture(self, kind, seconds):
+        """Profiles the whole event loop for `seconds` and returns the report path.
+
+        'cpu' runs cProfile (text report plus a .pstats file for snakeviz and
+        friends); 'mem' diffs tracemalloc snapshots taken at the start and end.
+        """
+        if self.capturing:
+            raise RuntimeError(f"a {self.capturing} capture is already running")
+        self.capturing = kind
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        os.makedirs(PERF_DIR, exist_ok=True)
+        try:
+            if kind == 'cpu':
+                path = os.path.join(PERF_DIR, f"profile-{stamp}.txt")
+                profiler = cProfile.Profile()
+                profiler.enable()
+                try:
+                    await asyncio.sleep(seconds)
+                finally:
+                    profiler.disable()
+                profiler.dump_stats(path[:-4] + ".pstats")
+                with open(path, "w") as f:
+                    pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(40)
+            else:
+                path = os.path.join(PERF_DIR, f"mem-{stamp}.txt")
+                started = not tracemalloc.is_tracing()
+                if started:
+                    tracemalloc.start()
+                try:
+                    before = tracemalloc.take_snapshot()
+                    await asyncio.sleep(seconds)
+                    after = tracemalloc.take_snapshot()
+                    current, peak = tracemalloc.get_traced_memory()
+                finally:
+                    if started:
+                        tracemalloc.stop()
+                with open(path, "w") as f:
+                    f.write(f"traced: {current / 1024:.0f} KiB now, {peak / 1024:.0f} KiB peak over {seconds}s\n\n")
+                    for stat in after.compare_to(before, "lineno")[:40]:
+                        f.write(f"{stat}\n")
+            return path
+        finally:
+            self.capturing = None
+
+perf = PerfSpans(PERF_SAMPLES)
+
+# Global Dictionary to store temporary captions; entries expire via `timers`
 # Structure: { user_id: {'text': "Caption", 'time': datetime_object} }
 pending_captions = {}
 
+# Dedup verdict of each album's first item, applied to the rest of the album
+# Structure: { media_group_id: is_duplicate }; entries expire via `timers`
+album_verdicts = {}
+
 # ================= DATABASE MANAGER =================
+# Pragmas applied once when the shared connection is opened.
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+    "PRAGMA busy_timeout=5000",
+)
+
+class DatabaseManager:
+    """Owns one long-lived aiosqlite connection shared by every handler and the worker.
+
+    sqlite3 keeps a per-connection statement cache, so reusing the same SQL strings
+    on one connection gives us prepared statements for free.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        if self.conn is None:
+            self.conn = await aiosqlite.connect(self.path, cached_statements=256)
+            self.conn.row_factory = aiosqlite.Row
+            for pragma in DB_PRAGMAS:
+                await self.conn.execute(pragma)
+        return self.conn
+
+    async def close(self):
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
+
+    async def fetchone(self, sql, params=()):
+        with Timer(db_latency, op='fetchone'):
+            async with self.conn.execute(sql, params) as cursor:
+                return await cursor.fetchone()
+
+    async def fetchall(self, sql, params=()):
+        with Timer(db_latency, op='fetchall'):
+            async with self.conn.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+
+    async def execute(self, sql, params=()):
+        """Runs a single write statement and commits it."""
+        with Timer(db_latency, op='execute'):
+            async with self.lock:
+                await self.conn.execute(sql, params)
+                await self.conn.commit()
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Serialises multi-statement writes so concurrent handlers don't interleave.
+
+        BEGIN IMMEDIATE takes SQLite's write lock up front, which makes each
+        transaction atomic against other processes sharing the file too.
+        """
+        with Timer(db_latency, op='transaction'):
+            async with self.lock:
+                try:
+                    await self.conn.execute("BEGIN IMMEDIATE")
+                    yield self.conn
+                    await self.conn.commit()
+                except BaseException:
+                    await self.conn.rollback()
+                    raise
+
+db = DatabaseManager(DB_NAME)
+
+class SettingsStore:
+    """Write-through, in-memory mirror of the settings table.
+
+    `version` is bumped on every change so callers can cache anything derived
+    from settings (e.g. the rendered caption) and rebuild it only when needed.
+    """
+
+    def __init__(self, database):
+        self.db = database
+        self.values = {}
+        self.version = 0
+
+    async def load(self):
+        rows = await self.db.fetchall("SELECT key, value FROM settings")
+        self.values = {row['key']: row['value'] for row in rows}
+        self.version += 1
+
+    def get(self, key):
+        return self.values.get(key)
+
+    async def update(self, changes, conn=None):
+        """Persists several keys in one transaction, then applies them in memory.
+
+        Pass `conn` to write as part of a transaction the caller already holds.
+        """
+        changes = {key: str(value) for key, value in changes.items()}
+        sql = "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)"
+        if conn is not None:
+            await conn.executemany(sql, changes.items())
+        else:
+            async with self.db.transaction() as conn:
+                await conn.executemany(sql, changes.items())
+        self.values.update(changes)
+        self.version += 1
+
+settings = SettingsStore(db)
+
+class Wakeup:
+    """Fan-out wakeup: each worker waits on its own event, so one clearing it can't hide work from another."""
+
+    def __init__(self):
+        self.events = {}
+
+    def event(self, key):
+        return self.events.setdefault(key, asyncio.Event())
+
+    def set(self):
+        for event in self.events.values():
+            event.set()
+
+# Set whenever there may be new work for the target workers (enqueue, /resume).
+# Each worker clears its event before looking for work, so no wakeup is ever lost.
+queue_event = Wakeup()
+
+class IngestBuffer:
+    """Group-commits incoming media rows into the queue table.
+
+    Rows are flushed in one transaction once `max_rows` are waiting or `max_delay`
+    seconds after the first one arrived. `pending` counts rows not yet sent
+    (buffered + in the table) so callers never need a COUNT(*). Spilled rows go
+    to the overflow table in the same transaction and don't count as pending.
+    """
+
+    def __init__(self, database, max_rows, max_delay):
+        self.db = database
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.rows = []
+        self.spilled = []
+        self.hashes = []
+        self.flush_task = None
+        self.flushes = set()
+        self.pending = 0
+
+    def add(self, row, media_hash=None, spill=False):
+        if spill:
+            self.spilled.append(row)
+        else:
+            self.rows.append(row)
+            self.pending += 1
+        if media_hash:
+            self.hashes.append(media_hash)
+        if len(self.rows) + len(self.spilled) >= self.max_rows:
+            task = asyncio.create_task(self.flush())
+            self.flushes.add(task)
+            task.add_done_callback(self.flushes.discard)
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        rows, self.rows = self.rows, []
+        spilled, self.spilled = self.spilled, []
+        hashes, self.hashes = self.hashes, []
+        if not rows and not spilled:
+            return
+        try:
+            with perf.span('ingest_flush'):
+                async with self.db.transaction() as conn:
+                    await conn.executemany(
+                        "INSERT INTO queue (user_id, message_id, media_type, media_group_id, priority, bot_id, publish_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        rows
+                    )
+                    await conn.executemany(
+                        "INSERT INTO overflow (user_id, message_id, media_type, media_group_id, priority, bot_id, publish_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        spilled
+                    )
+                    await conn.executemany(
+                        "INSERT OR REPLACE INTO media_hashes (file_unique_id, user_id, message_id, seen_at) VALUES (?, ?, ?, ?)",
+                        hashes
+                    )
+        except Exception as e:
+            # Keep the rows so the next flush retries them in order, even if no more arrive
+            logger.error(f"Queue flush failed: {e}")
+            self.rows[:0] = rows
+            self.spilled[:0] = spilled
+            self.hashes[:0] = hashes
+            if self.flush_task is None:
+                self.flush_task = asyncio.create_task(self.flush_later())
+            return
+        if rows:
+            queue_event.set()
+
+ingest = IngestBuffer(db, INGEST_FLUSH_ROWS, INGEST_FLUSH_MS / 1000)
+
+class FairScheduler:
+    """Picks which admin a target serves next: urgent lane first, then smooth weighted round-robin.
+
+    Only per-admin pending counts live in memory; once an admin is picked its rows
+    are read through the (user_id, status, priority, id) index, never a table scan.
+    Items with a future publish_at wait in a min-heap and join their lane when due.
+    """
+
+    def __init__(self, weights):
+        self.weights = weights
+        self.pending = {1: {}, 0: {}}
+        self.credit = {}
+        # chat_id -> (winner, {user_id: weight}) of the last pick, until charge()
+        self.picked = {}
+        # (publish_at, user_id, priority) -> count, plus a heap of those keys
+        self.later = {}
+        self.later_heap = []
+        # Pending per admin, due or scheduled, for the per-admin quota
+        self.totals = {}
+
+    def add(self, user_id, priority, count=1, publish_at=None):
+        self.totals[user_id] = self.totals.get(user_id, 0) + count
+        if publish_at and publish_at > time.time():
+            key = (publish_at, user_id, priority)
+            if key not in self.later:
+                heapq.heappush(self.later_heap, key)
+            self.later[key] = self.later.get(key, 0) + count
+            return
+        lane = self.pending[priority]
+        lane[user_id] = lane.get(user_id, 0) + count
+
+    def release(self, now):
+        """Moves scheduled items whose publish_at has come into their lanes."""
+        while self.later_heap and self.later_heap[0][0] <= now:
+            key = heapq.heappop(self.later_heap)
+            lane = self.pending[key[2]]
+            lane[key[1]] = lane.get(key[1], 0) + self.later.pop(key)
+
+    def next_release(self):
+        """Unix time the next scheduled items come due, or None."""
+        return self.later_heap[0][0] if self.later_heap else None
+
+    def releases(self):
+        """[(publish_at, count)] still scheduled, earliest first."""
+        totals = {}
+        for (publish_at, _, _), count in self.later.items():
+            totals[publish_at] = totals.get(publish_at, 0) + count
+        return sorted(totals.items())
+
+    def remove(self, user_id, priority, count=1):
+        self.totals[user_id] = self.totals.get(user_id, 0) - count
+        if self.totals[user_id] <= 0:
+            del self.totals[user_id]
+        lane = self.pending[priority]
+        lane[user_id] = lane.get(user_id, 0) - count
+        if lane[user_id] <= 0:
+            del lane[user_id]
+
+    def clear(self):
+        for lane in self.pending.values():
+            lane.clear()
+        self.later.clear()
+        self.later_heap.clear()
+        self.totals.clear()
+
+    def total(self, user_id):
+        return self.totals.get(user_id, 0)
+
+    def ahead_of(self, user_id, waiting=None):
+        """Due items that go out before `user_id`'s last one at the current counts and weights.
+
+        Higher lanes go first; within the admin's lowest lane, every other admin
+        gets `weight / their weight` items per item of theirs. `waiting` adds
+        per-admin counts (e.g. overflow) to the normal lane.
+        """
+        lanes = list(self.pending.values())
+        if waiting:
+            normal = dict(lanes[-1])
+            for other, n in waiting.items():
+                normal[other] = normal.get(other, 0) + n
+            lanes[-1] = normal
+        last = max((i for i, lane in enumerate(lanes) if lane.get(user_id)), default=None)
+        if last is None:
+            return 0
+        ahead = sum(sum(lane.values()) for lane in lanes[:last])
+        lane = lanes[last]
+        mine = lane[user_id]
+        share = mine / self.weights.get(user_id, 1)
+        ahead += mine + sum(min(n, share * self.weights.get(other, 1)) for other, n in lane.items() if other != user_id)
+        return ahead
+
+    def pick(self, chat_id, skip=()):
+        """Returns (priority, user_id) to serve next on `chat_id`, or None when idle.
+
+        Credit only moves in charge(), once the pick's unit is actually claimed, so
+        picks that find nothing sendable or lose the claim cost nobody a turn.
+        """
+        self.release(time.time())
+        for priority, lane in self.pending.items():
+            users = [user_id for user_id in lane if (priority, user_id) not in skip]
+            if not users:
+                continue
+            credit = self.credit.get(chat_id, {})
+            weights = {user_id: self.weights.get(user_id, 1) for user_id in users}
+            best = max(users, key=lambda user_id: credit.get(user_id, 0) + weights[user_id])
+            self.picked[chat_id] = (best, weights)
+            return priority, best
+        return None
+
+    def charge(self, chat_id):
+        """Settles the last pick on `chat_id`: every candidate earns its weight, the winner pays the total."""
+        picked = self.picked.pop(chat_id, None)
+        if picked is None:
+            return
+        best, weights = picked
+        credit = self.credit.setdefault(chat_id, {})
+        for user_id, weight in weights.items():
+            credit[user_id] = credit.get(user_id, 0) + weight
+        credit[best] -= sum(weights.values())
+
+scheduler = FairScheduler(ADMIN_WEIGHTS)
+
+# Admins whose next uploads go into the urgent lane (toggled with /urgent); kept
+# in the 'urgent_admins' setting so it survives restarts and reaches every process
+urgent_admins = set()
+
+def load_urgent_admins():
+    urgent_admins.clear()
+    urgent_admins.update(int(user_id) for user_id in (settings.get('urgent_admins') or "").split(",") if user_id)
+
+# Admins whose next uploads wait until a set time (/at): { user_id: unix time };
+# kept in the 'publish_times' setting ("user_id:time,...") like urgent_admins
+publish_times = {}
+
+def load_publish_times():
+    publish_times.clear()
+    for entry in (settings.get('publish_times') or "").split(","):
+        if entry:
+            user_id, publish_at = entry.split(":")
+            publish_times[int(user_id)] = float(publish_at)
+
+async def set_publish_time(user_id, publish_at):
+    """Schedules `user_id`'s next uploads for `publish_at` (None clears it)."""
+    times = dict(publish_times)
+    if publish_at is None:
+        times.pop(user_id, None)
+    else:
+        times[user_id] = publish_at
+    await update_setting('publish_times', ",".join(f"{a}:{t}" for a, t in sorted(times.items())))
+    load_publish_times()
+
+class QueueQuota:
+    """Admission control for add_to_queue: global and per-admin caps on pending items.
+
+    Decisions use the in-memory counters only (ingest.pending, scheduler totals).
+    Over the cap an upload is 'rejected', or spilled to the overflow table, which
+    promote() moves back into the queue, oldest first, as items go out. While an
+    admin has spilled items their new uploads spill too, so order is kept.
+    """
+
+    def __init__(self, max_total, max_per_admin, mode, max_overflow):
+        self.max_total = max_total
+        self.max_per_admin = max_per_admin
+        self.mode = mode
+        self.max_overflow = max_overflow
+        self.waiting = {}  # user_id -> spilled items
+        self.lock = asyncio.Lock()
+        # Promote in chunks so one freed slot doesn't cost one transaction
+        caps = [cap for cap in (max_total, max_per_admin) if cap]
+        self.chunk = max(1, min(caps) // 10) if caps else 1
+
+    def room(self, user_id):
+        """Items `user_id` may still add before a cap is hit (None: unlimited)."""
+        rooms = []
+        if self.max_total:
+            rooms.append(self.max_total - ingest.pending)
+        if self.max_per_admin:
+            rooms.append(self.max_per_admin - scheduler.total(user_id))
+        return max(0, min(rooms)) if rooms else None
+
+    def spilled(self):
+        return sum(self.waiting.values())
+
+    def admit(self, user_id):
+        """'accepted', 'overflow' or 'rejected' for one more upload from `user_id`."""
+        room = self.room(user_id)
+        if (room is None or room > 0) and not self.waiting.get(user_id):
+            return 'accepted'
+        if self.mode == 'spill' and (not self.max_overflow or self.spilled() < self.max_overflow):
+            self.waiting[user_id] = self.waiting.get(user_id, 0) + 1
+            return 'overflow'
+        return 'rejected'
+
+    async def load(self):
+        rows = await db.fetchall(
+            "SELECT user_id, COUNT(*) AS n FROM overflow WHERE bot_id = ? OR bot_id IS NULL GROUP BY user_id", (BOT_ID,)
+        )
+        self.waiting = {row['user_id']: row['n'] for row in rows}
+        for row in ingest.spilled:
+            self.waiting[row[0]] = self.waiting.get(row[0], 0) + 1
+
+    async def promote(self):
+        """Moves spilled items into the queue while there's room; returns how many moved."""
+        if not self.waiting or self.lock.locked():
+            return 0
+        async with self.lock:
+            wanted = {}
+            budget = self.max_total - ingest.pending if self.max_total else None
+            for user_id in list(self.waiting):
+                room = self.room(user_id)
+                take = self.waiting[user_id] if room is None else min(room, self.waiting[user_id])
+                if budget is not None:
+                    take = min(take, budget)
+                # Wait for a chunk of room unless the admin has nothing left in the queue
+                if take >= min(self.chunk, self.waiting[user_id]) or (take and not scheduler.total(user_id)):
+                    wanted[user_id] = take
+                    if budget is not None:
+                        budget -= take
+            if not wanted:
+                return 0
+            if ingest.spilled:
+                await ingest.flush()
+            moved = []
+            async with db.transaction() as conn:
+                for user_id, take in wanted.items():
+                    async with conn.execute(
+                        "SELECT * FROM overflow WHERE user_id = ? AND (bot_id = ? OR bot_id IS NULL) ORDER BY id LIMIT ?",
+                        (user_id, BOT_ID, take)
+                    ) as cursor:
+                        rows = await cursor.fetchall()
+                    if len(rows) < take:
+                        # Another process promoted some; that's all there is
+                        self.waiting[user_id] = len(rows)
+                    moved.extend(rows)
+                if not moved:
+                    self.waiting = {user_id: n for user_id, n in self.waiting.items() if n}
+                    return 0
+                ids = ", ".join("?" for _ in moved)
+                await conn.execute(f"""
+                    INSERT INTO queue (user_id, message_id, media_type, media_group_id, priority, bot_id, publish_at)
+                    SELECT user_id, message_id, media_type, media_group_id, priority, bot_id, publish_at
+                    FROM overflow WHERE id IN ({ids}) ORDER BY id
+                """, [row['id'] for row in moved])
+                await conn.execute(f"DELETE FROM overflow WHERE id IN ({ids})", [row['id'] for row in moved])
+            for row in moved:
+                scheduler.add(row['user_id'], row['priority'], publish_at=row['publish_at'])
+                ingest.pending += 1
+                self.waiting[row['user_id']] -= 1
+                if self.waiting[row['user_id']] <= 0:
+                    del self.waiting[row['user_id']]
+            queue_event.set()
+            return len(moved)
+
+quota = QueueQuota(MAX_PENDING, MAX_PENDING_PER_ADMIN, OVERFLOW_MODE, MAX_OVERFLOW)
+
+class DedupIndex:
+    """Recently queued media keyed by Telegram's file_unique_id (mirrors media_hashes)."""
+
+    def __init__(self, database):
+        self.db = database
+        self.seen = {}
+
+    async def load(self, window_hours):
+        cutoff = time.time() - window_hours * 3600
+        rows = await self.db.fetchall(
+            "SELECT file_unique_id, seen_at FROM media_hashes WHERE seen_at >= ?", (cutoff,)
+        )
+        self.seen = {row['file_unique_id']: row['seen_at'] for row in rows}
+
+    def is_duplicate(self, file_unique_id, window_hours):
+        if not file_unique_id or window_hours <= 0:
+            return False
+        seen_at = self.seen.get(file_unique_id)
+        return seen_at is not None and time.time() - seen_at < window_hours * 3600
+
+    def remember(self, file_unique_id, seen_at):
+        self.seen[file_unique_id] = seen_at
+
+    async def forget(self, conn, rows):
+        """Drops the hashes of queue `rows` (inside the caller's transaction), so a re-upload is accepted."""
+        keys = ", ".join("(?, ?)" for _ in rows)
+        params = [value for row in rows for value in (row['user_id'], row['message_id'])]
+        async with conn.execute(
+            f"SELECT file_unique_id FROM media_hashes WHERE (user_id, message_id) IN (VALUES {keys})", params
+        ) as cursor:
+            for row in await cursor.fetchall():
+                self.seen.pop(row[0], None)
+        await conn.execute(f"DELETE FROM media_hashes WHERE (user_id, message_id) IN (VALUES {keys})", params)
+
+    async def prune(self, window_hours):
+        if window_hours <= 0:
+            # Filter is off; keep the history in case it is switched back on
+            return
+        cutoff = time.time() - window_hours * 3600
+        self.seen = {key: ts for key, ts in self.seen.items() if ts >= cutoff}
+        await self.db.execute("DELETE FROM media_hashes WHERE seen_at < ?", (cutoff,))
+
+dedup = DedupIndex(db)
+
+class StatsBuffer:
+    """Per-admin send counters kept in memory and flushed to the DB in one transaction.
+
+    Besides the daily/lifetime totals in `stats`, sends are bucketed per UTC hour
+    into `stats_timeseries` so throughput can be reported without touching `queue`.
+    """
+
+    def __init__(self, database):
+        self.db = database
+        self.totals = {}
+        self.last_sent = {}
+        self.deltas = {}
+        self.hourly = {}
+        self.today = None
+        self.next_rollover = 0.0
+        self.hour_key = None
+        self.next_hour = 0.0
+
+    async def load(self):
+        self.roll_day()
+        rows = await self.db.fetchall("SELECT user_id, sent_today, sent_lifetime, last_updated, last_sent FROM stats")
+        for row in rows:
+            today = row['sent_today'] if row['last_updated'] == self.today else 0
+            self.totals[row['user_id']] = [today, row['sent_lifetime']]
+            self.last_sent[row['user_id']] = row['last_sent']
+
+    def roll_day(self):
+        self.today = date.today().isoformat()
+        tomorrow = datetime.combine(date.today() + timedelta(days=1), datetime.min.time())
+        self.next_rollover = tomorrow.timestamp()
+        for counts in self.totals.values():
+            counts[0] = 0
+
+    def record(self, user_id, count=1):
+        now = time.time()
+        if now >= self.next_rollover:
+            self.roll_day()
+        if now >= self.next_hour:
+            hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+            self.hour_key = hour.strftime("%Y-%m-%d %H:00")
+            self.next_hour = (hour + timedelta(hours=1)).timestamp()
+        counts = self.totals.setdefault(user_id, [0, 0])
+        counts[0] += count
+        counts[1] += count
+        self.last_sent[user_id] = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        self.deltas[user_id] = self.deltas.get(user_id, 0) + count
+        key = (self.hour_key, user_id)
+        self.hourly[key] = self.hourly.get(key, 0) + count
+
+    def get(self, user_id):
+        """Returns (sent_today, sent_lifetime)."""
+        return tuple(self.totals.get(user_id, (0, 0)))
+
+    def total_sent(self):
+        return sum(counts[1] for counts in self.totals.values())
+
+    async def flush(self):
+        if not self.deltas and not self.hourly:
+            return
+        deltas, self.deltas = self.deltas, {}
+        hourly, self.hourly = self.hourly, {}
+        rows = [(user_id, count, count, self.today, self.last_sent.get(user_id)) for user_id, count in deltas.items()]
+        try:
+            async with self.db.transaction() as conn:
+                # Increments rather than absolute values, so several processes can flush safely
+                await conn.executemany("""
+                    INSERT INTO stats (user_id, sent_today, sent_lifetime, last_updated, last_sent)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                    sent_today = CASE WHEN last_updated = excluded.last_updated
+                        THEN sent_today + excluded.sent_today ELSE excluded.sent_today END,
+                    sent_lifetime = sent_lifetime + excluded.sent_lifetime,
+                    last_updated = excluded.last_updated,
+                    last_sent = MAX(COALESCE(last_sent, ''), excluded.last_sent)
+                """, rows)
+                await conn.executemany("""
+                    INSERT INTO stats_timeseries (hour, user_id, sent) VALUES (?, ?, ?)
+                    ON CONFLICT(hour, user_id) DO UPDATE SET sent = sent + excluded.sent
+                """, [(hour, user_id, count) for (hour, user_id), count in hourly.items()])
+        except Exception as e:
+            logger.error(f"Stats flush failed: {e}")
+            for user_id, count in deltas.items():
+                self.deltas[user_id] = self.deltas.get(user_id, 0) + count
+            for key, count in hourly.items():
+                self.hourly[key] = self.hourly.get(key, 0) + count
+
+    async def throughput(self, hours, user_id=None):
+        """Sends per UTC hour over the last `hours` hours, oldest first, as (hour, sent) rows."""
+        await self.flush()
+        since = (datetime.now(timezone.utc) - timedelta(hours=hours - 1)).strftime("%Y-%m-%d %H:00")
+        if user_id is None:
+            return await self.db.fetchall(
+                "SELECT hour, SUM(sent) AS sent FROM stats_timeseries WHERE hour >= ? GROUP BY hour ORDER BY hour",
+                (since,)
+            )
+        return await self.db.fetchall(
+            "SELECT hour, sent FROM stats_timeseries WHERE hour >= ? AND user_id = ? ORDER BY hour",
+            (since, user_id)
+        )
+
+stats_buffer = StatsBuffer(db)
+
+class AdminProfiles:
+    """TTL cache of admin display names so /infoadmin doesn't call get_chat per admin."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.profiles = {}
+
+    async def fetch(self, bot, admin_id):
+        try:
+            chat = await bot.get_chat(admin_id)
+            name = chat.first_name + (f" {chat.last_name}" if chat.last_name else "")
+            username = f"@{chat.username}" if chat.username else "No Username"
+            self.profiles[admin_id] = (name, username, time.monotonic())
+        except Exception as e:
+            logger.warning(f"Profile lookup failed for {admin_id}: {e}")
+
+    async def refresh(self, bot, admin_ids, force=False):
+        """Looks up every missing/stale profile concurrently."""
+        now = time.monotonic()
+        stale = [
+            admin_id for admin_id in admin_ids
+            if force or now - self.profiles.get(admin_id, (None, None, -self.ttl))[2] >= self.ttl
+        ]
+        if stale:
+            await asyncio.gather(*(self.fetch(bot, admin_id) for admin_id in stale))
+
+    def get(self, admin_id):
+        name, username, _ = self.profiles.get(admin_id, ("Unknown Admin", "Unknown", 0))
+        return name, username
+
+    async def run(self, bot, admin_ids):
+        """Background refresh so the dashboard normally never waits on the Bot API."""
+        while True:
+            await self.refresh(bot, admin_ids, force=True)
+            await asyncio.sleep(self.ttl / 2)
+
+admin_profiles = AdminProfiles(PROFILE_TTL)
+
 async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("""
+    await db.connect()
+    if (await db.fetchone("PRAGMA auto_vacuum"))[0] != 2:
+        # One-off conversion so the retention job can hand pages back with incremental_vacuum
+        await db.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        await db.conn.execute("VACUUM")
+    async with db.transaction() as conn:
+        await conn.execute("""
             CREATE TABLE IF NOT EXISTS settings (
                 key TEXT PRIMARY KEY,
                 value TEXT
@@ -71,89 +937,711 @@ async def init_db():
             'join_enabled': '0',
             'custom_text': '',
             'custom_remaining': '0',
-            'total_off': '0'
+            'total_off': '0',
+            'dedup_hours': '24',
+            'urgent_admins': '',
+            'publish_times': ''
         }
         
-        for key, val in defaults.items():
-            await db.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", (key, val))
+        await conn.executemany(
+            "INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", defaults.items()
+        )
 
-        await db.execute("""
+        await conn.execute("""
             CREATE TABLE IF NOT EXISTS stats (
                 user_id INTEGER,
                 sent_today INTEGER DEFAULT 0,
                 sent_lifetime INTEGER DEFAULT 0,
                 last_updated DATE,
+                last_sent DATETIME,
                 PRIMARY KEY (user_id)
             )
         """)
         
-        await db.execute("""
+        await conn.execute("""
             CREATE TABLE IF NOT EXISTS queue (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER,
                 message_id INTEGER,
                 media_type TEXT,
                 status TEXT DEFAULT 'pending',
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                media_group_id TEXT,
+                caption TEXT,
+                priority INTEGER DEFAULT 0,
+                bot_id INTEGER,
+                publish_at REAL,
+                finished_at DATETIME
+            )
+        """)
+        await ensure_column(conn, 'queue', 'media_group_id', 'TEXT')
+        await ensure_column(conn, 'queue', 'caption', 'TEXT')
+        await ensure_column(conn, 'queue', 'priority', 'INTEGER DEFAULT 0')
+        await ensure_column(conn, 'queue', 'bot_id', 'INTEGER')
+        # Unix time an item may go out (NULL = as soon as possible)
+        await ensure_column(conn, 'queue', 'publish_at', 'REAL')
+        # When the row was acked or cancelled; retention ages finished rows by this
+        await ensure_column(conn, 'queue', 'finished_at', 'DATETIME')
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_queue_status_id ON queue (status, id)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_queue_user_status ON queue (user_id, status, id)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_queue_user_lane ON queue (user_id, status, priority, id)")
+        # Covers load_pending, so startup counts a large backlog without touching the table
+        await conn.execute("DROP INDEX IF EXISTS idx_queue_pending_lanes")
+        await conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_queue_pending_publish ON queue (status, user_id, priority, publish_at, bot_id)"
+        )
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS queue_archive (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                message_id INTEGER,
+                media_type TEXT,
+                status TEXT,
+                timestamp DATETIME,
+                media_group_id TEXT,
+                archived_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                finished_at DATETIME
+            )
+        """)
+        await ensure_column(conn, 'queue_archive', 'finished_at', 'DATETIME')
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_archive_user_status ON queue_archive (user_id, status, id)")
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS media_hashes (
+                file_unique_id TEXT PRIMARY KEY,
+                user_id INTEGER,
+                message_id INTEGER,
+                seen_at REAL
+            )
+        """)
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_media_hashes_seen ON media_hashes (seen_at)")
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS stats_timeseries (
+                hour TEXT,
+                user_id INTEGER,
+                sent INTEGER DEFAULT 0,
+                PRIMARY KEY (hour, user_id)
+            )
+        """)
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_timeseries_user_hour ON stats_timeseries (user_id, hour)")
+        await ensure_column(conn, 'stats', 'last_sent', 'DATETIME')
+
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS destinations (
+                chat_id INTEGER PRIMARY KEY,
+                title TEXT,
+                added_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                windows TEXT,
+                quiet TEXT
+            )
+        """)
+        # Posting windows / quiet hours, e.g. '09:00-13:00,18:00-23:00' in DISPLAY_TZ
+        await ensure_column(conn, 'destinations', 'windows', 'TEXT')
+        await ensure_column(conn, 'destinations', 'quiet', 'TEXT')
+        async with conn.execute("SELECT COUNT(*) FROM destinations") as cursor:
+            if (await cursor.fetchone())[0] == 0:
+                await conn.execute("INSERT INTO destinations (chat_id, title) VALUES (?, 'Main')", (TARGET_GROUP_ID,))
+
+        # One row per item per target: 'sending' while leased by a worker, 'retry' while
+        # waiting for next_attempt_at, then 'sent', 'dead' (see dead_letters) or 'skipped'
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS deliveries (
+                queue_id INTEGER,
+                chat_id INTEGER,
+                status TEXT,
+                sent_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                owner TEXT,
+                lease_until REAL,
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL,
+                error TEXT,
+                PRIMARY KEY (queue_id, chat_id)
+            )
+        """)
+        await ensure_column(conn, 'deliveries', 'owner', 'TEXT')
+        await ensure_column(conn, 'deliveries', 'lease_until', 'REAL')
+        await ensure_column(conn, 'deliveries', 'attempts', 'INTEGER DEFAULT 0')
+        await ensure_column(conn, 'deliveries', 'next_attempt_at', 'REAL')
+        await ensure_column(conn, 'deliveries', 'error', 'TEXT')
+        await conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_deliveries_retry ON deliveries (chat_id, status, next_attempt_at)"
+        )
+        # Finds in-flight sends without scanning finished ones
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_deliveries_inflight ON deliveries (status, lease_until)")
+
+        # Processes draining the queue, so a restart can tell whose sends were cut off
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS workers (
+                worker_id TEXT PRIMARY KEY,
+                host TEXT,
+                pid INTEGER,
+                started_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                pid_started INTEGER
+            )
+        """)
+        # Process start time (clock ticks since boot), so a reused pid isn't taken for the old worker
+        await ensure_column(conn, 'workers', 'pid_started', 'INTEGER')
+
+        # Uploads over the pending quota (OVERFLOW_MODE=spill), promoted into queue oldest first
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS overflow (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                message_id INTEGER,
+                media_type TEXT,
+                media_group_id TEXT,
+                priority INTEGER DEFAULT 0,
+                bot_id INTEGER,
+                publish_at REAL,
+                spilled_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_overflow_user ON overflow (user_id, id)")
+
+        # Sends that ran out of attempts; /requeue puts them back as fresh queue rows
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                queue_id INTEGER,
+                chat_id INTEGER,
+                user_id INTEGER,
+                message_id INTEGER,
+                media_type TEXT,
+                media_group_id TEXT,
+                caption TEXT,
+                priority INTEGER,
+                bot_id INTEGER,
+                attempts INTEGER,
+                error TEXT,
+                failed_at DATETIME DEFAULT CURRENT_TIMESTAMP
             )
         """)
-        await db.commit()
+    await settings.load()
+    load_urgent_admins()
+    load_publish_times()
+    await stats_buffer.load()
+    await load_targets()
+    if TARGET_GROUP_ID not in targets:
+        # The env value only seeds an empty destinations table
+        logger.warning(
+            f"TARGET_GROUP_ID {TARGET_GROUP_ID} is not a configured destination; posting to "
+            f"{', '.join(str(chat_id) for chat_id in targets) or 'nothing'}. Use /addtarget and /removetarget."
+        )
+    await dedup.load(int(settings.get('dedup_hours')))
+    await load_pending()
+    # After load_pending, so completing these later takes them off the counters
+    recovered_items.extend(await recover_in_flight())
+
+# Items recover_in_flight settled before the bot existed; queue_processor completes them
+recovered_items = []
+
+async def load_pending():
+    """Seeds the in-memory pending counters from the table (startup and /cancel)."""
+    rows = await db.fetchall("""
+        SELECT user_id, priority, publish_at, COUNT(*) AS n FROM queue
+        WHERE status='pending' AND (bot_id = ? OR bot_id IS NULL) GROUP BY user_id, priority, publish_at
+    """, (BOT_ID,))
+    scheduler.clear()
+    ingest.pending = 0
+    for row in rows:
+        scheduler.add(row['user_id'], row['priority'], row['n'], row['publish_at'])
+        ingest.pending += row['n']
+    # Rows still waiting in the ingest buffer aren't in the table yet
+    for user_id, _, _, _, priority, _, publish_at in ingest.rows:
+        scheduler.add(user_id, priority, publish_at=publish_at)
+        ingest.pending += 1
+    await quota.load()
+    # Room may have freed up while nobody was completing items (startup, /cancel)
+    await quota.promote()
+
+async def ensure_column(conn, table, column, decl):
+    """Adds a column to a table created by an older version of the bot."""
+    async with conn.execute(f"PRAGMA table_info({table})") as cursor:
+        columns = [row['name'] for row in await cursor.fetchall()]
+    if column not in columns:
+        await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
 
 async def get_setting(key):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT value FROM settings WHERE key = ?", (key,)) as cursor:
-            row = await cursor.fetchone()
-            return row[0] if row else None
+    return settings.get(key)
 
 async def update_setting(key, value):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
-        await db.commit()
-
-async def add_to_queue(user_id, message_id, media_type):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "INSERT INTO queue (user_id, message_id, media_type) VALUES (?, ?, ?)",
-            (user_id, message_id, media_type)
-        )
-        await db.commit()
-        async with db.execute("SELECT COUNT(*) FROM queue WHERE status='pending'") as cursor:
-            return (await cursor.fetchone())[0]
-
-async def update_stats(user_id):
-    today = date.today().isoformat()
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT last_updated FROM stats WHERE user_id = ?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            if row and row[0] != today:
-                await db.execute("UPDATE stats SET sent_today = 0, last_updated = ? WHERE user_id = ?", (today, user_id))
-        
-        await db.execute("""
-            INSERT INTO stats (user_id, sent_today, sent_lifetime, last_updated)
-            VALUES (?, 1, 1, ?)
-            ON CONFLICT(user_id) DO UPDATE SET
-            sent_today = sent_today + 1,
-            sent_lifetime = sent_lifetime + 1,
-            last_updated = ?
-        """, (user_id, today, today))
-        await db.commit()
+    await settings.update({key: value})
+
+async def update_settings(changes):
+    await settings.update(changes)
+
+async def add_to_queue(user_id, message_id, media_type, media_group_id=None, file_unique_id=None):
+    """Buffers the row for the next group commit; returns 'accepted', 'overflow' or 'rejected' (see QueueQuota)."""
+    outcome = quota.admit(user_id)
+    if outcome == 'rejected':
+        rejected_total.inc()
+        return outcome
+    priority = 1 if user_id in urgent_admins else 0
+    publish_at = publish_times.get(user_id)
+    if publish_at is not None and publish_at <= time.time():
+        # The scheduled time has come; later uploads go out right away again
+        await set_publish_time(user_id, None)
+        publish_at = None
+    row = (user_id, message_id, media_type, media_group_id, priority, BOT_ID, publish_at)
+    if outcome == 'overflow':
+        ingest.add(row, spill=True)
+        return outcome
+    # Only accepted uploads count for dedup; one waiting in overflow may be sent again
+    media_hash = None
+    if file_unique_id:
+        seen_at = time.time()
+        dedup.remember(file_unique_id, seen_at)
+        media_hash = (file_unique_id, user_id, message_id, seen_at)
+    ingest.add(row, media_hash)
+    scheduler.add(user_id, priority, publish_at=publish_at)
+    return outcome
+
+async def update_stats(user_id, count=1):
+    stats_buffer.record(user_id, count)
 
 async def get_queue_counts():
-    async with aiosqlite.connect(DB_NAME) as db:
-        pending = (await (await db.execute("SELECT COUNT(*) FROM queue WHERE status='pending'")).fetchone())[0]
-        total_sent = (await (await db.execute("SELECT SUM(sent_lifetime) FROM stats")).fetchone())[0] or 0
-        return pending, total_sent
-
-async def get_next_item():
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM queue WHERE status='pending' ORDER BY id ASC LIMIT 1") as cursor:
-            return await cursor.fetchone()
-
-async def mark_as_sent(queue_id):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("UPDATE queue SET status='sent' WHERE id = ?", (queue_id,))
-        await db.commit()
+    pending = ingest.pending
+    total_sent = stats_buffer.total_sent()
+    return pending, total_sent
+
+async def get_admin_summary(admin_ids):
+    """Today/lifetime/last-24h counts and last send time for every admin in one query."""
+    await stats_buffer.flush()
+    since = (datetime.now(timezone.utc) - timedelta(hours=23)).strftime("%Y-%m-%d %H:00")
+    admins = ", ".join("(?)" for _ in admin_ids)
+    # Older databases have no stats.last_sent yet, so fall back to the queue/archive rows
+    rows = await db.fetchall(f"""
+        WITH admins(user_id) AS (VALUES {admins})
+        SELECT a.user_id,
+            CASE WHEN s.last_updated = ? THEN s.sent_today ELSE 0 END AS sent_today,
+            COALESCE(s.sent_lifetime, 0) AS sent_lifetime,
+            COALESCE(
+                s.last_sent,
+                (SELECT COALESCE(q.finished_at, q.timestamp) FROM queue q WHERE q.user_id = a.user_id AND q.status = 'sent' ORDER BY q.id DESC LIMIT 1),
+                (SELECT COALESCE(q.finished_at, q.timestamp) FROM queue_archive q WHERE q.user_id = a.user_id AND q.status = 'sent' ORDER BY q.id DESC LIMIT 1)
+            ) AS last_sent,
+            (SELECT COALESCE(SUM(t.sent), 0) FROM stats_timeseries t WHERE t.user_id = a.user_id AND t.hour >= ?) AS last_day
+        FROM admins a LEFT JOIN stats s ON s.user_id = a.user_id
+    """, (*admin_ids, stats_buffer.today, since))
+    return {row['user_id']: row for row in rows}
+
+# Destinations the queue fans out to: { chat_id: title }
+targets = {}
+
+async def load_targets():
+    rows = await db.fetchall("SELECT chat_id, title, windows, quiet FROM destinations ORDER BY added_at")
+    targets.clear()
+    targets.update({row['chat_id']: row['title'] for row in rows})
+    target_hours.rules.clear()
+    for row in rows:
+        target_hours.set(row['chat_id'], parse_time_ranges(row['windows'] or ""), parse_time_ranges(row['quiet'] or ""))
+
+async def add_target(chat_id, title):
+    await db.execute("INSERT OR REPLACE INTO destinations (chat_id, title) VALUES (?, ?)", (chat_id, title))
+    targets[chat_id] = title
+    target_hours.set(chat_id, [], [])
+
+async def set_target_hours(chat_id, windows=None, quiet=None):
+    """Stores a target's posting windows and/or quiet hours (lists of minute ranges)."""
+    current_windows, current_quiet = target_hours.get(chat_id)
+    windows = current_windows if windows is None else windows
+    quiet = current_quiet if quiet is None else quiet
+    await db.execute(
+        "UPDATE destinations SET windows = ?, quiet = ? WHERE chat_id = ?",
+        (format_time_ranges(windows) or None, format_time_ranges(quiet) or None, chat_id)
+    )
+    target_hours.set(chat_id, windows, quiet)
+
+async def remove_target(chat_id):
+    await db.execute("DELETE FROM destinations WHERE chat_id = ?", (chat_id,))
+    targets.pop(chat_id, None)
+
+# Each send is journaled on its delivery row: 'sending' (intent, written before the API
+# call), then 'sent' once Telegram answers; the queue row turning 'sent' acks the item.
+# A delivery row blocks its item unless it's a retry that's due (takes the current time).
+DELIVERY_BLOCKS = "NOT (d.status = 'retry' AND d.next_attempt_at <= ?)"
+# Delivery states that settle an item for its target
+DELIVERY_DONE = "('sent', 'dead', 'skipped')"
+
+def queued_at(timestamp):
+    """Unix time of a queue row's `timestamp` (UTC, whole seconds)."""
+    return datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+
+def ready_rows(rows, now, limit):
+    """Cuts `rows` before any album that may still be growing; returns (rows, when the first such album settles).
+
+    Telegram delivers album items as separate updates, so an album only goes out
+    once ALBUM_QUIET_SECONDS passed without a new item. An album cut off by the
+    fetch LIMIT continues past the last row, so it waits for the next fetch.
+    """
+    if len(rows) == limit and rows[-1]['media_group_id']:
+        group_id = rows[-1]['media_group_id']
+        while rows and rows[-1]['media_group_id'] == group_id:
+            rows = rows[:-1]
+    newest = {}
+    for row in rows:
+        if row['media_group_id']:
+            newest[row['media_group_id']] = max(newest.get(row['media_group_id'], 0), queued_at(row['timestamp']))
+    for i, row in enumerate(rows):
+        settles_at = newest.get(row['media_group_id'], 0) + ALBUM_QUIET_SECONDS
+        if row['media_group_id'] and settles_at > now:
+            return rows[:i], settles_at
+    return rows, None
+
+# chat_id -> when an album get_next_run held back settles, for the worker's wait
+album_settles = {}
+
+async def get_next_run(chat_id, limit=100):
+    """Next rows for `chat_id` from the admin/lane the scheduler picks, oldest first."""
+    skip = set()
+    album_settles.pop(chat_id, None)
+    while True:
+        pick = scheduler.pick(chat_id, skip)
+        if pick is None:
+            return []
+        priority, user_id = pick
+        now = time.time()
+        rows = await db.fetchall(f"""
+            SELECT q.*, COALESCE((SELECT d.attempts FROM deliveries d WHERE d.queue_id = q.id AND d.chat_id = ?), 0) AS attempts
+            FROM queue q WHERE q.user_id = ? AND q.status='pending' AND q.priority = ?
+            AND (q.bot_id = ? OR q.bot_id IS NULL) AND (q.publish_at IS NULL OR q.publish_at <= ?)
+            AND NOT EXISTS (
+                SELECT 1 FROM deliveries d WHERE d.queue_id = q.id AND d.chat_id = ? AND {DELIVERY_BLOCKS}
+            )
+            ORDER BY q.id ASC LIMIT ?
+        """, (chat_id, user_id, priority, BOT_ID, now, chat_id, now, limit))
+        rows, settles_at = ready_rows([dict(row) for row in rows], now, limit)
+        if settles_at is not None:
+            album_settles[chat_id] = min(album_settles.get(chat_id, settles_at), settles_at)
+        if rows:
+            return rows
+        # Everything of theirs is done here, waiting for a retry, an album or still buffered; try the next admin
+        skip.add(pick)
+
+async def claim_unit(chat_id, queue_ids):
+    """Atomically leases the rows to this worker for `chat_id`; False if any is already taken.
+
+    A retry whose next_attempt_at has passed may be claimed again; a lease that
+    outlives LEASE_SECONDS is left to reap_in_doubt.
+    """
+    ids = ", ".join("?" for _ in queue_ids)
+    now = time.time()
+    async with db.transaction() as conn:
+        async with conn.execute(f"""
+            SELECT COUNT(*) FROM deliveries d WHERE d.chat_id = ? AND d.queue_id IN ({ids}) AND {DELIVERY_BLOCKS}
+        """, (chat_id, *queue_ids, now)) as cursor:
+            if (await cursor.fetchone())[0]:
+                return False
+        # Upsert so a retried delivery keeps its attempt count
+        await conn.executemany("""
+            INSERT INTO deliveries (queue_id, chat_id, status, owner, lease_until) VALUES (?, ?, 'sending', ?, ?)
+            ON CONFLICT(queue_id, chat_id) DO UPDATE SET
+            status = 'sending', owner = excluded.owner, lease_until = excluded.lease_until
+        """, [(queue_id, chat_id, WORKER_ID, now + LEASE_SECONDS) for queue_id in queue_ids])
+    return True
+
+async def release_unit(chat_id, queue_ids):
+    """Drops this worker's leases so the rows can be picked again (e.g. after RetryAfter)."""
+    await db.execute(
+        f"UPDATE deliveries SET status = 'retry', next_attempt_at = 0 WHERE chat_id = ? AND owner = ? "
+        f"AND status = 'sending' AND queue_id IN ({', '.join('?' for _ in queue_ids)})",
+        (chat_id, WORKER_ID, *queue_ids)
+    )
+
+async def settled_items(conn, queue_ids):
+    """Ids among `queue_ids` that every current target has settled."""
+    enabled = list(targets)
+    marks = ", ".join("?" for _ in enabled)
+    ids = ", ".join("?" for _ in queue_ids)
+    async with conn.execute(f"""
+        SELECT queue_id FROM deliveries WHERE queue_id IN ({ids}) AND chat_id IN ({marks})
+        AND status IN {DELIVERY_DONE} GROUP BY queue_id HAVING COUNT(*) >= ?
+    """, (*queue_ids, *enabled, len(enabled))) as cursor:
+        return [row[0] for row in await cursor.fetchall()]
+
+async def record_deliveries(chat_id, queue_ids, status):
+    """Journals per-target status and acks items every current target has now settled (see ack_items)."""
+    async with db.transaction() as conn:
+        await conn.executemany("""
+            INSERT INTO deliveries (queue_id, chat_id, status, owner, sent_at) VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(queue_id, chat_id) DO UPDATE SET
+            status = excluded.status, owner = excluded.owner, sent_at = excluded.sent_at
+        """, [(queue_id, chat_id, status, WORKER_ID) for queue_id in queue_ids])
+        return await ack_items(conn, await settled_items(conn, queue_ids))
+
+def retry_delay(attempts):
+    """Exponential backoff with +-20% jitter so failed sends don't retry in lockstep."""
+    return min(RETRY_MAX, RETRY_BASE * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+
+async def record_failure(chat_id, queue_ids, error, permanent=False):
+    """Schedules a retry for each row, or dead-letters it once attempts run out.
+
+    Acks and returns items every current target has now settled, like record_deliveries.
+    """
+    ids = ", ".join("?" for _ in queue_ids)
+    now = time.time()
+    async with db.transaction() as conn:
+        async with conn.execute(f"""
+            SELECT q.*, COALESCE(d.attempts, 0) + 1 AS attempt FROM queue q
+            LEFT JOIN deliveries d ON d.queue_id = q.id AND d.chat_id = ? WHERE q.id IN ({ids})
+        """, (chat_id, *queue_ids)) as cursor:
+            rows = await cursor.fetchall()
+        dead = [row for row in rows if permanent or row['attempt'] >= MAX_ATTEMPTS]
+        await conn.executemany("""
+            INSERT INTO deliveries (queue_id, chat_id, status, owner, attempts, next_attempt_at, error)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(queue_id, chat_id) DO UPDATE SET
+            status = excluded.status, owner = excluded.owner, attempts = excluded.attempts,
+            next_attempt_at = excluded.next_attempt_at, error = excluded.error
+        """, [
+            (row['id'], chat_id, 'dead' if row in dead else 'retry', WORKER_ID,
+             row['attempt'], None if row in dead else now + retry_delay(row['attempt']), error)
+            for row in rows
+        ])
+        await file_dead_letters(conn, chat_id, dead, error)
+        return await ack_items(conn, await settled_items(conn, queue_ids))
+
+async def file_dead_letters(conn, chat_id, rows, error):
+    """Copies queue rows (with an `attempt` count) into dead_letters for `chat_id`."""
+    await conn.executemany("""
+        INSERT INTO dead_letters (queue_id, chat_id, user_id, message_id, media_type, media_group_id,
+                                  caption, priority, bot_id, attempts, error)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, [
+        (row['id'], chat_id, row['user_id'], row['message_id'], row['media_type'], row['media_group_id'],
+         row['caption'], row['priority'], row['bot_id'], row['attempt'], error)
+        for row in rows
+    ])
+
+def process_start_time(pid):
+    """Start time of `pid` in clock ticks since boot, or None where /proc isn't available."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # The command name may contain spaces; the fields after it are fixed
+            return int(f.read().rsplit(")", 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+def process_alive(pid, started=None):
+    """True if `pid` is running and, when its start time is known, is still the same process."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    if started is not None:
+        current = process_start_time(pid)
+        return current is None or current == started
+    return True
+
+async def recover_in_flight():
+    """Startup recovery: registers this worker and settles sends dead workers left in flight.
+
+    A worker is known dead if it ran on this host and its pid is gone (or now
+    belongs to a process started later), or if it was an earlier run under our
+    own WORKER_ID. Sends held by workers elsewhere are settled once their lease
+    expires. Returns the items that are now settled, for complete_items.
+    """
+    host = socket.gethostname()
+    async with db.transaction() as conn:
+        async with conn.execute("SELECT worker_id, host, pid, pid_started FROM workers") as cursor:
+            dead = [
+                row['worker_id'] for row in await cursor.fetchall()
+                if row['worker_id'] == WORKER_ID
+                or (row['host'] == host and not process_alive(row['pid'], row['pid_started']))
+            ]
+        await conn.executemany("DELETE FROM workers WHERE worker_id = ?", [(worker_id,) for worker_id in dead])
+        await conn.execute(
+            "INSERT INTO workers (worker_id, host, pid, pid_started) VALUES (?, ?, ?, ?)",
+            (WORKER_ID, host, os.getpid(), process_start_time(os.getpid()))
+        )
+    settled = await reap_in_doubt(dead)
+    if settled:
+        logger.info(f"Recovered {len(settled)} interrupted sends ({RECOVERY_MODE}).")
+    return settled
+
+async def reap_in_doubt(dead_owners=()):
+    """Settles 'sending' rows whose lease expired or whose worker is dead.
+
+    Nobody knows whether those reached Telegram, so RECOVERY_MODE decides: 'hold'
+    dead-letters them, 'resend' makes them due again. Acks and returns the reaped
+    items that are now settled for every target.
+    """
+    owners = ", ".join("?" for _ in dead_owners) or "NULL"
+    async with db.transaction() as conn:
+        async with conn.execute(f"""
+            SELECT q.*, d.chat_id, COALESCE(d.attempts, 0) AS attempt FROM deliveries d
+            JOIN queue q ON q.id = d.queue_id
+            WHERE d.status = 'sending' AND (d.lease_until < ? OR d.owner IN ({owners}))
+        """, (time.time(), *dead_owners)) as cursor:
+            rows = await cursor.fetchall()
+        if not rows:
+            return []
+        keys = [(row['id'], row['chat_id']) for row in rows]
+        if RECOVERY_MODE == 'resend':
+            await conn.executemany(
+                "UPDATE deliveries SET status = 'retry', next_attempt_at = 0 WHERE queue_id = ? AND chat_id = ?", keys
+            )
+            return []
+        error = "Interrupted mid-send; check the target before requeueing"
+        await conn.executemany(
+            "UPDATE deliveries SET status = 'dead', error = ? WHERE queue_id = ? AND chat_id = ?",
+            [(error, *key) for key in keys]
+        )
+        by_target = {}
+        for row in rows:
+            by_target.setdefault(row['chat_id'], []).append(row)
+        for chat_id, target_rows in by_target.items():
+            await file_dead_letters(conn, chat_id, target_rows, error)
+        return await ack_items(conn, await settled_items(conn, list({row['id'] for row in rows})))
+
+async def next_retry_in(chat_id):
+    """Seconds until the earliest scheduled retry for `chat_id`, or None."""
+    row = await db.fetchone(
+        "SELECT MIN(d.next_attempt_at) AS due FROM deliveries d JOIN queue q ON q.id = d.queue_id "
+        "WHERE d.chat_id = ? AND d.status = 'retry' AND q.status = 'pending'", (chat_id,)
+    )
+    if row['due'] is None:
+        return None
+    return max(0, row['due'] - time.time())
+
+async def get_failure_counts():
+    """(deliveries waiting for a retry, dead letters)."""
+    row = await db.fetchone("""
+        SELECT (SELECT COUNT(*) FROM deliveries WHERE status = 'retry') AS retrying,
+               (SELECT COUNT(*) FROM dead_letters) AS dead
+    """)
+    return row['retrying'], row['dead']
+
+async def get_dead_letters(limit=15):
+    return await db.fetchall("SELECT * FROM dead_letters ORDER BY id DESC LIMIT ?", (limit,))
+
+async def requeue_dead_letters(ids=None):
+    """Puts dead letters back in the queue as fresh rows meant only for their target.
+
+    The original item may be archived by now, so a new row is inserted with the
+    caption it had and marked 'skipped' for every other target. Returns rows requeued.
+    """
+    where = f"WHERE id IN ({', '.join('?' for _ in ids)})" if ids else ""
+    added = []
+    async with db.transaction() as conn:
+        async with conn.execute(f"SELECT * FROM dead_letters {where}", ids or ()) as cursor:
+            rows = await cursor.fetchall()
+        for row in rows:
+            if row['chat_id'] not in targets:
+                # Its destination was removed; leave it for inspection
+                continue
+            cursor = await conn.execute("""
+                INSERT INTO queue (user_id, message_id, media_type, media_group_id, caption, priority, bot_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (row['user_id'], row['message_id'], row['media_type'], row['media_group_id'],
+                  row['caption'] or '', row['priority'], row['bot_id']))
+            await conn.executemany(
+                "INSERT INTO deliveries (queue_id, chat_id, status) VALUES (?, ?, 'skipped')",
+                [(cursor.lastrowid, chat_id) for chat_id in targets if chat_id != row['chat_id']]
+            )
+            await conn.execute("DELETE FROM dead_letters WHERE id = ?", (row['id'],))
+            added.append(row)
+    for row in added:
+        scheduler.add(row['user_id'], row['priority'])
+        ingest.pending += 1
+    if added:
+        queue_event.set()
+    return len(added)
+
+async def get_fully_delivered():
+    """Pending ids every current target has settled (used after a target is removed)."""
+    enabled = list(targets)
+    marks = ", ".join("?" for _ in enabled)
+    rows = await db.fetchall(f"""
+        SELECT d.queue_id FROM deliveries d JOIN queue q ON q.id = d.queue_id
+        WHERE q.status='pending' AND d.chat_id IN ({marks}) AND d.status IN {DELIVERY_DONE}
+        GROUP BY d.queue_id HAVING COUNT(*) >= ?
+    """, (*enabled, len(enabled)))
+    return [row[0] for row in rows]
+
+async def get_target_backlog():
+    """Pending items each target still has to send: { chat_id: count }."""
+    rows = await db.fetchall(f"""
+        SELECT d.chat_id, COUNT(*) AS done FROM deliveries d
+        JOIN queue q ON q.id = d.queue_id WHERE q.status='pending' AND d.status IN {DELIVERY_DONE}
+        AND (q.bot_id = ? OR q.bot_id IS NULL) GROUP BY d.chat_id
+    """, (BOT_ID,))
+    done = {row['chat_id']: row['done'] for row in rows}
+    return {chat_id: ingest.pending - done.get(chat_id, 0) for chat_id in targets}
+
+async def ack_items(conn, queue_ids):
+    """Moves settled rows out of 'pending' and returns the rows that actually changed.
+
+    Runs inside the caller's transaction, so an item is acked in the same commit
+    that journals its last delivery. An item reaching no target at all ends up
+    'failed'. Each row carries `sent` and `dead`, its per-target delivery counts.
+    """
+    if not queue_ids:
+        return []
+    ids = ", ".join("?" for _ in queue_ids)
+    async with conn.execute(f"""
+        SELECT q.id, q.user_id, q.message_id, q.priority,
+        (SELECT COUNT(*) FROM deliveries d WHERE d.queue_id = q.id AND d.status = 'sent') AS sent,
+        (SELECT COUNT(*) FROM deliveries d WHERE d.queue_id = q.id AND d.status = 'dead') AS dead
+        FROM queue q WHERE q.status='pending' AND q.id IN ({ids})
+    """, queue_ids) as cursor:
+        rows = await cursor.fetchall()
+    await conn.executemany(
+        "UPDATE queue SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+        [('sent' if row['sent'] else 'failed', row['id']) for row in rows]
+    )
+    # Dead-lettered everywhere: a re-upload of the same file must not be skipped
+    failed = [row for row in rows if not row['sent']]
+    if failed:
+        await dedup.forget(conn, failed)
+    return rows
+
+async def mark_many_as_sent(queue_ids):
+    async with db.transaction() as conn:
+        return await ack_items(conn, queue_ids)
+
+caption_lock = asyncio.Lock()
+
+async def assign_captions(rows):
+    """Fixes the caption of the next post so every target sends the same text.
+
+    The first target to reach an item decides its caption and spends
+    custom_remaining in the same transaction. With no caption in effect the
+    whole run is settled at once so it can go out in one bulk call.
+    """
+    if rows[0]['caption'] is not None:
+        return rows
+    async with caption_lock:
+        caption = current_caption()
+        if caption:
+            unit = album_unit(rows)
+        else:
+            unit = [r for r in rows if r['caption'] is None]
+        ids = ", ".join("?" for _ in unit)
+        async with db.transaction() as conn:
+            async with conn.execute(f"SELECT id, caption FROM queue WHERE id IN ({ids})", [r['id'] for r in unit]) as cursor:
+                decided = {row['id']: row['caption'] for row in await cursor.fetchall()}
+            if any(value is not None for value in decided.values()):
+                # Another target got here first; use what it decided
+                for row in rows:
+                    if decided.get(row['id']) is not None:
+                        row['caption'] = decided[row['id']]
+                return rows
+            await conn.executemany("UPDATE queue SET caption = ? WHERE id = ?", [(caption, r['id']) for r in unit])
+            # Decrease custom count if it's not infinite (-1); one album counts once.
+            # Read inside the transaction: another process may have spent some already.
+            async with conn.execute("SELECT key, value FROM settings WHERE key IN ('custom_remaining', 'total_off')") as cursor:
+                current = {row['key']: row['value'] for row in await cursor.fetchall()}
+            cust_rem = int(current.get('custom_remaining', -1))
+            if current.get('total_off') != '1' and cust_rem > 0:
+                await settings.update({'custom_remaining': cust_rem - 1}, conn)
+        for row in unit:
+            row['caption'] = caption
+    return rows
 
 # ================= HELPERS =================
 def is_admin(user_id):
@@ -168,32 +1656,517 @@ def build_progress_text(sent_batch, total_batch, total_queue, today, lifetime, d
         f"⏲ <b>Current Delay :</b> {delay}s"
     )
 
+def get_file_unique_id(msg):
+    media = msg.video or msg.animation or msg.document or (msg.photo[-1] if msg.photo else None)
+    return media.file_unique_id if media else None
+
+def album_unit(rows):
+    """The head row's album (consecutive rows sharing its media_group_id), or just the head row."""
+    group_id = rows[0]['media_group_id']
+    album = []
+    for row in rows:
+        if not group_id or row['media_group_id'] != group_id:
+            break
+        album.append(row)
+    return album or rows[:1]
+
+def next_unit(rows, limit=100):
+    """Rows that go out in the next API call: a bulk run of uncaptioned rows, or one captioned post.
+
+    A bulk run stops at `limit` messages, but only between albums; the first
+    album always goes out whole. Rows that already failed here go out on their
+    own (with their album), so one bad message can't keep failing a whole bulk run.
+    """
+    if rows[0]['caption'] == "" and not rows[0].get('attempts'):
+        unit = []
+        while rows and rows[0]['caption'] == "" and not rows[0].get('attempts'):
+            album = album_unit(rows)
+            if unit and len(unit) + len(album) > limit:
+                break
+            unit += album
+            rows = rows[len(album):]
+        return unit
+    return [r for r in album_unit(rows) if r['caption'] == rows[0]['caption']]
+
+caption_cache = {'version': None, 'text': ""}
+
+def current_caption():
+    """build_caption(), re-rendered only when a setting actually changed."""
+    if caption_cache['version'] != settings.version:
+        caption_cache['text'] = build_caption()
+        caption_cache['version'] = settings.version
+    return caption_cache['text']
+
+def build_caption():
+    """Renders the caption from the current settings (custom text + join footer)."""
+    if settings.get('total_off') == '1':
+        return ""
+    caption = ""
+    if int(settings.get('custom_remaining')) != 0:
+        caption += settings.get('custom_text') + "\n\n"
+    if settings.get('join_enabled') == '1':
+        caption += f"For More Video <a href='{settings.get('link')}'>Join Here</a>"
+    return caption
+
+def retry_after_seconds(error):
+    """RetryAfter.retry_after is an int or a timedelta depending on the PTB version."""
+    if isinstance(error.retry_after, timedelta):
+        return error.retry_after.total_seconds()
+    return float(error.retry_after)
+
+def parse_time_ranges(text):
+    """'09:00-13:00,22:00-02:00' -> [(540, 780), (1320, 120)] in minutes of the day."""
+    ranges = []
+    for part in text.replace(" ", "").split(","):
+        if not part:
+            continue
+        start, end = part.split("-")
+        bounds = []
+        for value in (start, end):
+            hours, minutes = value.split(":")
+            if not (0 <= int(hours) < 24 and 0 <= int(minutes) < 60) and value != "24:00":
+                raise ValueError(f"bad time {value}")
+            bounds.append((int(hours) * 60 + int(minutes)) % 1440)
+        ranges.append(tuple(bounds))
+    return ranges
+
+def format_time_ranges(ranges):
+    return ",".join(f"{s // 60:02d}:{s % 60:02d}-{e // 60:02d}:{e % 60:02d}" for s, e in ranges)
+
+def in_time_range(minute, start, end):
+    # A range may wrap past midnight; start == end means all day
+    if start < end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+class TargetHours:
+    """When each target may be posted to: inside a posting window (if it has any) and outside quiet hours.
+
+    Ranges are minutes of the day in DISPLAY_TZ. Open/close times are found by
+    checking the range boundaries of the next few days, so the worker can sleep
+    straight to the next opening.
+    """
+
+    def __init__(self):
+        self.rules = {}  # chat_id -> (windows, quiet)
+
+    def set(self, chat_id, windows, quiet):
+        if windows or quiet:
+            self.rules[chat_id] = (windows, quiet)
+        else:
+            self.rules.pop(chat_id, None)
+
+    def get(self, chat_id):
+        return self.rules.get(chat_id, ([], []))
+
+    def is_open(self, chat_id, ts):
+        rule = self.rules.get(chat_id)
+        if rule is None:
+            return True
+        windows, quiet = rule
+        local = datetime.fromtimestamp(ts, DISPLAY_TZ)
+        minute = local.hour * 60 + local.minute + local.second / 60
+        if windows and not any(in_time_range(minute, s, e) for s, e in windows):
+            return False
+        return not any(in_time_range(minute, s, e) for s, e in quiet)
+
+    def next_change(self, chat_id, ts):
+        """First time after `ts` the target opens or closes, or None if it never does."""
+        rule = self.rules.get(chat_id)
+        if rule is None:
+            return None
+        bounds = sorted({minute for ranges in rule for pair in ranges for minute in pair})
+        state = self.is_open(chat_id, ts)
+        today = datetime.fromtimestamp(ts, DISPLAY_TZ).date()
+        for offset in range(9):
+            midnight = datetime.combine(today + timedelta(days=offset), datetime.min.time())
+            for minute in bounds:
+                at = DISPLAY_TZ.localize(midnight + timedelta(minutes=minute)).timestamp()
+                if at > ts and self.is_open(chat_id, at) != state:
+                    return at
+        return None
+
+    def opens_at(self, chat_id, ts):
+        """`ts` if the target is open then, else when it next opens (None: never)."""
+        if self.is_open(chat_id, ts):
+            return ts
+        return self.next_change(chat_id, ts)
+
+target_hours = TargetHours()
+
+def project_drain(chat_id, backlog, rate, now, releases=None):
+    """Unix time `chat_id` should be through `backlog` items sending `rate` items/s.
+
+    Walks forward through the target's open hours, adding scheduled items
+    (`releases`, default all of them) as they come due. None if the target never opens.
+    """
+    if releases is None:
+        releases = scheduler.releases()
+    remaining = max(0, backlog - sum(count for _, count in releases))
+    t = now
+    i = 0
+    for _ in range(1000):
+        while i < len(releases) and releases[i][0] <= t:
+            remaining += releases[i][1]
+            i += 1
+        next_release = releases[i][0] if i < len(releases) else None
+        if remaining <= 0:
+            if next_release is None:
+                return t
+            t = next_release
+            continue
+        opens = target_hours.opens_at(chat_id, t)
+        if opens is None:
+            return None
+        if opens > t:
+            t = opens
+            continue
+        ends = [at for at in (target_hours.next_change(chat_id, t), next_release) if at is not None]
+        end = min(ends) if ends else None
+        if end is None or (end - t) * rate >= remaining:
+            t += remaining / rate
+            remaining = 0
+        else:
+            remaining -= (end - t) * rate
+            t = end
+    return t
+
+def send_rate_estimate(chat_id):
+    """Items/s for projections: the target's API rate (floor 1/delay), or what actually
+    went out in the last minute if higher, since bulk copies move many items per call."""
+    recent = sum(n for at, n in recent_sends if at > time.monotonic() - 60) / 60
+    return max(rate_limiter.current_rate(chat_id) or 1 / int(settings.get('delay')), recent)
+
+def format_eta(ts, now):
+    """'18:40 (in 2h 05m)' in DISPLAY_TZ, with the date when it isn't today."""
+    local = datetime.fromtimestamp(ts, DISPLAY_TZ)
+    seconds = max(0, int(ts - now))
+    if seconds < 60:
+        return "within a minute"
+    when = local.strftime("%H:%M") if local.date() == datetime.now(DISPLAY_TZ).date() else local.strftime("%d-%b %H:%M")
+    hours, minutes = divmod(seconds // 60, 60)
+    return f"{when} (in {hours}h {minutes:02d}m)" if hours else f"{when} (in {minutes}m)"
+
+# ================= RATE LIMITER =================
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.floor = rate
+        self.burst = burst
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+class RateLimiter:
+    """Per-chat token buckets whose rate adapts AIMD-style to RetryAfter feedback.
+
+    Every success adds `increase` msg/s (default a tenth of `max_rate`) up to
+    `max_rate`; a RetryAfter multiplies the rate by `decrease` and blocks the
+    chat for the time Telegram asked for. The /delay setting is the floor: the
+    rate never backs off below 1/delay.
+    """
+
+    def __init__(self, max_rate, burst, increase=None, decrease=0.5):
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase if increase is not None else max_rate / 10
+        self.decrease = decrease
+        self.buckets = {}
+
+    def bucket(self, chat_id, floor_rate):
+        floor_rate = min(floor_rate, self.max_rate)
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.buckets[chat_id] = TokenBucket(floor_rate, self.burst)
+        bucket.floor = floor_rate
+        bucket.rate = min(max(bucket.rate, floor_rate), self.max_rate)
+        return bucket
+
+    async def acquire(self, chat_id, floor_rate, count=1):
+        """Waits until `count` messages may be sent to `chat_id`.
+
+        A post larger than the burst (an album, a bulk run) goes out once a token
+        is there and leaves the bucket in debt, so the next send waits it off.
+        """
+        bucket = self.bucket(chat_id, floor_rate)
+        while True:
+            now = time.monotonic()
+            if now < bucket.blocked_until:
+                await asyncio.sleep(bucket.blocked_until - now)
+                continue
+            bucket.refill(now)
+            if bucket.tokens >= 1:
+                bucket.tokens -= count
+                return
+            await asyncio.sleep((1 - bucket.tokens) / bucket.rate)
+
+    def on_success(self, chat_id):
+        bucket = self.buckets.get(chat_id)
+        if bucket:
+            bucket.rate = min(bucket.rate + self.increase, self.max_rate)
+
+    def on_retry_after(self, chat_id, seconds):
+        bucket = self.buckets.get(chat_id)
+        if bucket:
+            bucket.rate = max(bucket.rate * self.decrease, bucket.floor)
+            bucket.tokens = min(bucket.tokens, 0.0)
+            bucket.blocked_until = time.monotonic() + seconds
+
+    def ready_at(self, chat_id):
+        """Monotonic time the next send to `chat_id` may go (0 if it has no bucket yet)."""
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            return 0.0
+        refilled = bucket.updated + max(0.0, 1 - bucket.tokens) / bucket.rate
+        return max(bucket.blocked_until, refilled)
+
+    def current_rate(self, chat_id):
+        bucket = self.buckets.get(chat_id)
+        return bucket.rate if bucket else None
+
+rate_limiter = RateLimiter(MAX_SEND_RATE, SEND_BURST)
+
+# ================= PROGRESS & CLEANUP =================
+class ProgressReporter:
+    """Keeps one live progress message per admin and edits it at most every `interval` seconds."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.messages = {}
+        self.last_flush = {}
+        self.dirty = set()
+        self.batch_sent = 0
+
+    def touch(self, user_id):
+        self.dirty.add(user_id)
+
+    def due(self, user_id):
+        return time.monotonic() - self.last_flush.get(user_id, 0) >= self.interval
+
+    async def publish(self, bot, user_id, text):
+        self.dirty.discard(user_id)
+        self.last_flush[user_id] = time.monotonic()
+        message_id = self.messages.get(user_id)
+        if message_id:
+            try:
+                await bot.edit_message_text(chat_id=user_id, message_id=message_id, text=text, parse_mode=ParseMode.HTML)
+                return
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    return
+                # The admin deleted the old message; fall through and post a new one
+            except TelegramError as e:
+                logger.warning(f"Progress edit failed: {e}")
+                return
+        try:
+            msg = await bot.send_message(chat_id=user_id, text=text, parse_mode=ParseMode.HTML)
+            self.messages[user_id] = msg.message_id
+        except TelegramError as e:
+            logger.warning(f"Progress send failed: {e}")
+
+    def finish(self):
+        """Forgets the live messages so the next batch starts a fresh one."""
+        self.messages.clear()
+        self.last_flush.clear()
+        self.batch_sent = 0
+
+class CleanupQueue:
+    """Deletes forwarded source messages in the background, batched per chat.
+
+    Uses its own rate limiter so deletes never eat into the forwarding budget.
+    """
+
+    def __init__(self, limiter, chunk=100):
+        self.limiter = limiter
+        self.chunk = chunk
+        self.pending = {}
+        self.event = asyncio.Event()
+
+    def add(self, chat_id, message_ids):
+        self.pending.setdefault(chat_id, []).extend(message_ids)
+        self.event.set()
+
+    async def run(self, bot):
+        while True:
+            try:
+                self.event.clear()
+                if not self.pending:
+                    await self.event.wait()
+                    continue
+
+                chat_id = next(iter(self.pending))
+                ids = self.pending.pop(chat_id)
+                chunk, rest = ids[:self.chunk], ids[self.chunk:]
+                if rest:
+                    self.pending[chat_id] = rest
+
+                await self.limiter.acquire(chat_id, self.limiter.max_rate)
+                try:
+                    with perf.span('delete'):
+                        await bot.delete_messages(chat_id=chat_id, message_ids=chunk)
+                except RetryAfter as e:
+                    self.pending.setdefault(chat_id, [])[:0] = chunk
+                    self.limiter.on_retry_after(chat_id, retry_after_seconds(e))
+                except TelegramError as e:
+                    logger.warning(f"Cleanup failed for {chat_id}: {e}")
+            except Exception as e:
+                logger.error(f"Cleanup Error: {e}")
+                await asyncio.sleep(5)
+
+progress = ProgressReporter(PROGRESS_INTERVAL)
+cleanup_queue = CleanupQueue(RateLimiter(max_rate=1, burst=1))
+
 # ================= BATCH NOTIFICATION LOGIC =================
+class DeadlineScheduler:
+    """One coroutine firing keyed callbacks at their deadlines.
+
+    Used for debouncing (the batch summary) and expiry (saved captions) instead
+    of a sleeping task per admin. Pushing a deadline back is O(1): the old heap
+    entry is re-pushed when it comes up early. Moving one forward is a heap push;
+    stale entries are dropped when the heap grows past twice the live keys.
+    """
+
+    def __init__(self):
+        self.deadlines = {}  # key -> (deadline, async callback, args)
+        self.heap = []       # (deadline, key), possibly stale
+        self.wakeup = asyncio.Event()
+        self.running = set()  # callbacks in flight
+
+    def schedule(self, key, delay, callback, *args):
+        """(Re)arms `key` to await `callback(*args)` after `delay` seconds."""
+        deadline = time.monotonic() + delay
+        current = self.deadlines.get(key)
+        self.deadlines[key] = (deadline, callback, args)
+        if current is None or deadline < current[0]:
+            heapq.heappush(self.heap, (deadline, key))
+            if self.heap[0][1] == key:
+                self.wakeup.set()
+            if len(self.heap) > 2 * len(self.deadlines) + 64:
+                self.heap = [(entry[0], key) for key, entry in self.deadlines.items()]
+                heapq.heapify(self.heap)
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    async def fire(self, key, callback, args):
+        try:
+            await callback(*args)
+        except Exception as e:
+            logger.error(f"Timer {key} failed: {e}")
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            now = time.monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                deadline, key = heapq.heappop(self.heap)
+                entry = self.deadlines.get(key)
+                if entry is None or entry[0] < deadline:
+                    # Cancelled, or fired/re-armed through an earlier entry
+                    continue
+                if entry[0] > deadline:
+                    heapq.heappush(self.heap, (entry[0], key))
+                    continue
+                del self.deadlines[key]
+                # Each callback runs as its own task, so a slow Telegram reply
+                # can't hold up the other deadlines
+                task = asyncio.create_task(self.fire(key, entry[1], entry[2]))
+                self.running.add(task)
+                task.add_done_callback(self.running.discard)
+            timeout = self.heap[0][0] - now if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+# Summary goes out once an admin has sent nothing for this long; a caption text
+# applies to media sent within CAPTION_WINDOW_SECONDS
+BATCH_QUIET_SECONDS = 3
+CAPTION_WINDOW_SECONDS = 5
+# Telegram delivers an album's items within a second or two of each other; an
+# album is posted once no new item came for ALBUM_QUIET_SECONDS
+ALBUM_WINDOW_SECONDS = 60
+ALBUM_QUIET_SECONDS = 3
+
+timers = DeadlineScheduler()
+# { user_id: {'count': n, 'dupes': n, 'last_msg': Message} } until the summary is sent
 batch_buffer = {}
 
 async def send_batch_notification(user_id):
-    """Waits a moment, then sends the summary message."""
+    """Sends the summary once the admin has been quiet for BATCH_QUIET_SECONDS."""
+    # Taken out first, so media arriving while we reply starts a new batch
+    data = batch_buffer.pop(user_id, None)
+    if data is None:
+        return
+    pending, _ = await get_queue_counts()
+
+    text = (
+        f"📥 <b>Batch Received!</b>\n"
+        f"━━━━━━━━━━━━━━━━━━\n"
+        f"📎 <b>Added:</b> {data['count']} files\n"
+        f"🔢 <b>Total in Queue:</b> {pending}"
+    )
+    if data['dupes']:
+        text += f"\n♻️ <b>Duplicates Skipped:</b> {data['dupes']}"
+    if data['overflow']:
+        text += f"\n📦 <b>In Overflow:</b> {data['overflow']} (joins the queue as space frees)"
+    if data['rejected']:
+        text += f"\n⛔ <b>Rejected (queue full):</b> {data['rejected']}"
+    if data['count'] and settings.get('paused') != '1':
+        eta = admin_eta(user_id, time.time())
+        text += f"\n⏳ <b>Your Files Out By:</b> {format_eta(eta, time.time()) if eta else 'never (no open hours)'}"
+    publish_at = publish_times.get(user_id)
+    if publish_at is not None and publish_at > time.time():
+        text += f"\n🗓 <b>Publishing at:</b> {format_eta(publish_at, time.time())}"
     try:
-        await asyncio.sleep(3)
-        if user_id in batch_buffer:
-            data = batch_buffer[user_id]
-            count = data['count']
-            last_msg = data['last_msg']
-            pending, _ = await get_queue_counts()
-            
-            text = (
-                f"📥 <b>Batch Received!</b>\n"
-                f"━━━━━━━━━━━━━━━━━━\n"
-                f"📎 <b>Added:</b> {count} files\n"
-                f"🔢 <b>Total in Queue:</b> {pending}"
-            )
-            try:
-                await last_msg.reply_text(text, parse_mode=ParseMode.HTML)
-            except Exception as e:
-                logger.error(f"Failed to send batch reply: {e}")
-            del batch_buffer[user_id]
-    except asyncio.CancelledError:
-        pass
+        with perf.span('notify'):
+            await data['last_msg'].reply_text(text, parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logger.error(f"Failed to send batch reply: {e}")
+
+def note_batch(user_id, msg, count=0, dupes=0, overflow=0, rejected=0):
+    """Adds to the admin's running batch, pushes its summary back and returns the batch."""
+    data = batch_buffer.get(user_id)
+    if data is None:
+        data = batch_buffer[user_id] = {'count': 0, 'dupes': 0, 'overflow': 0, 'rejected': 0}
+    data['count'] += count
+    data['dupes'] += dupes
+    data['overflow'] += overflow
+    data['rejected'] += rejected
+    data['last_msg'] = msg
+    timers.schedule(('batch', user_id), BATCH_QUIET_SECONDS, send_batch_notification, user_id)
+    return data
+
+def quota_notice(user_id, outcome):
+    """Immediate reply for the first upload of a batch that didn't fit in the queue."""
+    limits = []
+    if quota.max_per_admin and scheduler.total(user_id) >= quota.max_per_admin:
+        limits.append(f"your limit of {quota.max_per_admin}")
+    if quota.max_total and ingest.pending >= quota.max_total:
+        limits.append(f"the global limit of {quota.max_total}")
+    reason = " and ".join(limits) or "files still waiting in overflow"
+    if outcome == 'overflow':
+        return f"📦 <b>Queue full</b> ({reason}). Further files wait in overflow and join the queue as space frees up."
+    return f"⛔ <b>Queue full</b> ({reason}). Further files are <b>not</b> queued; send them again later."
+
+def admin_eta(user_id, now):
+    """Unix time `user_id`'s due items should all be out, over the slowest target."""
+    ahead = scheduler.ahead_of(user_id, quota.waiting)
+    if not ahead:
+        return now
+    start = max(now, publish_times.get(user_id) or now)
+    etas = [project_drain(chat_id, ahead, send_rate_estimate(chat_id), start, releases=()) for chat_id in targets]
+    return None if None in etas else max(etas, default=now)
+
+async def expire_caption(user_id):
+    pending_captions.pop(user_id, None)
+
+async def expire_album(media_group_id):
+    album_verdicts.pop(media_group_id, None)
 
 # ================= COMMAND HANDLERS =================
 
@@ -213,11 +2186,22 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (
         "<b>🛠 Command List:</b>\n\n"
         "<b>⚙️ Basic:</b>\n"
-        "/delay X - Set interval (min 5s)\n"
+        "/delay X - Slowest interval (min 5s)\n"
         "/info - Show stats & config\n"
         "/infoadmin - Admin Dashboard\n"
         "/hold - Pause /resume - Resume\n"
-        "/cancel - Clear queue\n\n"
+        "/cancel - Clear queue\n"
+        "/urgent - Toggle priority lane for your uploads\n"
+        "/at HH:MM|+2h|off - Publish your next uploads later\n"
+        "/targets - List destinations\n"
+        "/addtarget ID {name} - Add destination\n"
+        "/removetarget ID - Remove destination\n"
+        "/window ID 09:00-23:00|off - Posting hours\n"
+        "/quiet ID 01:00-07:00|off - Quiet hours\n"
+        "/dedup X - Skip repeats within X hours (0 = off)\n"
+        "/failed - List sends that gave up\n"
+        "/requeue ID|all - Retry failed sends\n"
+        "/perf - Stage timings (reset | cpu N | mem N)\n\n"
         "<b>📝 Caption Management:</b>\n"
         "<i>Just send text to set caption for next video!</i>\n"
         "/link {url} - Set Join Link\n"
@@ -237,10 +2221,237 @@ async def delay_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("⚠️ <b>Delay must be >= 5s.</b>", parse_mode=ParseMode.HTML)
             return
         await update_setting('delay', new_delay)
-        await update.message.reply_text(f"✅ Delay updated to <b>{new_delay}s</b>.", parse_mode=ParseMode.HTML)
+        await update.message.reply_text(
+            f"✅ Delay updated to <b>{new_delay}s</b>.\n"
+            f"<i>Sends go faster (up to {MAX_SEND_RATE:g}/s) while Telegram allows it.</i>",
+            parse_mode=ParseMode.HTML
+        )
     except:
         await update.message.reply_text("❌ Usage: `/delay 10`", parse_mode=ParseMode.HTML)
 
+async def dedup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id): return
+    try:
+        hours = int(context.args[0])
+        if hours < 0:
+            raise ValueError
+        await update_setting('dedup_hours', hours)
+        await dedup.load(hours)
+        state = "OFF" if hours == 0 else f"{hours}h window"
+        await update.message.reply_text(f"♻️ <b>Duplicate Filter:</b> {state}", parse_mode=ParseMode.HTML)
+    except:
+        await update.message.reply_text("❌ Usage: `/dedup 24` (Use 0 to disable)", parse_mode=ParseMode.HTML)
+
+async def urgent_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id): return
+    if user_id in urgent_admins:
+        await update_setting('urgent_admins', ",".join(str(a) for a in sorted(urgent_admins - {user_id})))
+        load_urgent_admins()
+        await update.message.reply_text("🐢 <b>Urgent lane OFF.</b> New uploads queue normally.", parse_mode=ParseMode.HTML)
+    else:
+        await update_setting('urgent_admins', ",".join(str(a) for a in sorted(urgent_admins | {user_id})))
+        load_urgent_admins()
+        await update.message.reply_text("🚀 <b>Urgent lane ON.</b> Your next uploads jump the queue. Send /urgent again to stop.", parse_mode=ParseMode.HTML)
+
+def parse_publish_time(text, now):
+    """'18:30', '2025-01-31 18:30', '+45m', '+2h' or '+1d' -> unix time (DISPLAY_TZ)."""
+    if text.startswith("+"):
+        units = {'m': 60, 'h': 3600, 'd': 86400}
+        return now + float(text[1:-1]) * units[text[-1].lower()]
+    local_now = datetime.fromtimestamp(now, DISPLAY_TZ)
+    if " " in text:
+        when = DISPLAY_TZ.localize(datetime.strptime(text, "%Y-%m-%d %H:%M"))
+    else:
+        clock = datetime.strptime(text, "%H:%M")
+        when = DISPLAY_TZ.localize(datetime.combine(local_now.date(), clock.time()))
+        if when <= local_now:
+            # A time that already passed today means tomorrow
+            when = DISPLAY_TZ.localize(datetime.combine(local_now.date() + timedelta(days=1), clock.time()))
+    return when.timestamp()
+
+async def at_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id): return
+    now = time.time()
+    if not context.args:
+        publish_at = publish_times.get(user_id)
+        if publish_at is None or publish_at <= now:
+            await update.message.reply_text("▶️ <b>No schedule.</b> Your uploads go out right away.", parse_mode=ParseMode.HTML)
+        else:
+            await update.message.reply_text(f"🗓 <b>Your next uploads publish at:</b> {format_eta(publish_at, now)}", parse_mode=ParseMode.HTML)
+        return
+    if context.args[0].lower() == 'off':
+        await set_publish_time(user_id, None)
+        await update.message.reply_text("▶️ <b>Schedule OFF.</b> New uploads go out right away.", parse_mode=ParseMode.HTML)
+        return
+    try:
+        publish_at = parse_publish_time(" ".join(context.args), now)
+    except:
+        await update.message.reply_text("❌ Usage: <code>/at 18:30</code>, <code>/at 2025-01-31 18:30</code>, <code>/at +2h</code> or <code>/at off</code>", parse_mode=ParseMode.HTML)
+        return
+    await set_publish_time(user_id, publish_at)
+    await update.message.reply_text(
+        f"🗓 <b>Scheduled!</b> Your next uploads publish at {format_eta(publish_at, now)}.\nSend /at off to go back to posting right away.",
+        parse_mode=ParseMode.HTML
+    )
+
+async def targets_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id): return
+    backlog = await get_target_backlog()
+    lines = "\n".join(
+        f"• {title} (<code>{chat_id}</code>) - {backlog[chat_id]} left{describe_target_hours(chat_id)}"
+        for chat_id, title in targets.items()
+    )
+    await update.message.reply_text(f"🎯 <b>Destinations:</b>\n{lines}", parse_mode=ParseMode.HTML)
+
+async def failed_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id): return
+    rows = await get_dead_letters()
+    if not rows:
+        await update.message.reply_text("✅ <b>No failed sends.</b>", parse_mode=ParseMode.HTML)
+        return
+    lines = "\n".join(
+        f"• <code>{row['id']}</code> {row['media_type']} → {targets.get(row['chat_id'], row['chat_id'])} "
+        f"({row['attempts']}x): {html.escape((row['error'] or '')[:60])}"
+        for row in rows
+    )
+    await update.message.reply_text(
+        f"💀 <b>Failed Sends:</b>\n{lines}\n\n<i>/requeue ID or /requeue all</i>", parse_mode=ParseMode.HTML
+    )
+
+async def requeue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id): return
+    try:
+        arg = context.args[0]
+        ids = None if arg.lower() == 'all' else [int(value) for value in context.args]
+    except:
+        await update.message.reply_text("❌ Usage: <code>/requeue ID</code> or <code>/requeue all</code>", parse_mode=ParseMode.HTML)
+        return
+    count = await requeue_dead_letters(ids)
+    await update.message.reply_text(f"🔁 <b>Requeued:</b> {count}", parse_mode=ParseMode.HTML)
+
+async def perf_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id): return
+    arg = context.args[0].lower() if context.args else ''
+    if arg == 'reset':
+        perf.reset()
+        await update.message.reply_text("🧽 <b>Timings Reset.</b>", parse_mode=ParseMode.HTML)
+        return
+    if arg in ('cpu', 'mem'):
+        try:
+            seconds = min(int(context.args[1]), 600) if len(context.args) > 1 else 30
+        except:
+            await update.message.reply_text("❌ Usage: <code>/perf cpu 30</code> or <code>/perf mem 30</code>", parse_mode=ParseMode.HTML)
+            return
+        if perf_tasks:
+            await update.message.reply_text("⚠️ <b>A capture is already running.</b>", parse_mode=ParseMode.HTML)
+            return
+        # Run in the background so updates keep flowing while we measure them
+        task = asyncio.create_task(perf_capture(update.message, arg, seconds))
+        perf_tasks.add(task)
+        task.add_done_callback(perf_tasks.discard)
+        await update.message.reply_text(f"🔬 <b>Profiling ({arg}) for {seconds}s...</b>", parse_mode=ParseMode.HTML)
+        return
+
+    rows = perf.summary()
+    if not rows:
+        await update.message.reply_text("📭 <b>No timings yet.</b>", parse_mode=ParseMode.HTML)
+        return
+    items = max(perf.items, 1)
+    table = f"{'stage':<13}{'p50':>8}{'p95':>8}{'p99':>8}{'/item':>7}\n"
+    table += "\n".join(
+        f"{stage:<13}{p50:>8.1f}{p95:>8.1f}{p99:>8.1f}{calls / items:>7.2f}"
+        for stage, p50, p95, p99, calls in rows
+    )
+    minutes = (time.monotonic() - perf.since) / 60
+    await update.message.reply_text(
+        f"⏱ <b>Stage Timings (ms)</b>\n"
+        f"━━━━━━━━━━━━━━━━━━\n"
+        f"<pre>{html.escape(table)}</pre>\n"
+        f"📦 <b>Items done:</b> {perf.items} in {minutes:.1f} min\n"
+        f"<i>/perf reset · /perf cpu N · /perf mem N</i>",
+        parse_mode=ParseMode.HTML
+    )
+
+perf_tasks = set()
+
+async def perf_capture(msg, kind, seconds):
+    try:
+        path = await perf.capture(kind, seconds)
+        await msg.reply_text(f"✅ <b>Profile saved:</b> <code>{html.escape(path)}</code>", parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logger.error(f"Profile capture failed: {e}")
+        await msg.reply_text(f"❌ <b>Profile failed:</b> {html.escape(str(e))}", parse_mode=ParseMode.HTML)
+
+async def addtarget_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id): return
+    try:
+        chat_id = int(context.args[0])
+        title = " ".join(context.args[1:]) or str(chat_id)
+    except:
+        await update.message.reply_text("❌ Usage: `/addtarget -1001234567890 Channel Name`", parse_mode=ParseMode.HTML)
+        return
+    await add_target(chat_id, title)
+    start_target_worker(context.application, chat_id)
+    await update.message.reply_text(f"✅ <b>Destination Added:</b> {title} (<code>{chat_id}</code>)", parse_mode=ParseMode.HTML)
+
+async def removetarget_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id): return
+    try:
+        chat_id = int(context.args[0])
+    except:
+        await update.message.reply_text("❌ Usage: `/removetarget -1001234567890`", parse_mode=ParseMode.HTML)
+        return
+    if chat_id not in targets:
+        await update.message.reply_text("⚠️ <b>Not a destination.</b>", parse_mode=ParseMode.HTML)
+        return
+    if len(targets) == 1:
+        await update.message.reply_text("⚠️ <b>At least one destination is required.</b>", parse_mode=ParseMode.HTML)
+        return
+    await remove_target(chat_id)
+    stop_target_worker(chat_id)
+    # Items that were only waiting on this destination are done now
+    await complete_items(context.bot, await mark_many_as_sent(await get_fully_delivered()))
+    await update.message.reply_text(f"🗑 <b>Destination Removed:</b> <code>{chat_id}</code>", parse_mode=ParseMode.HTML)
+
+async def target_hours_command(update, context, kind):
+    """/window and /quiet: `kind` is 'windows' or 'quiet'."""
+    if not is_admin(update.effective_user.id): return
+    command = "window" if kind == 'windows' else "quiet"
+    try:
+        chat_id = int(context.args[0])
+        value = " ".join(context.args[1:])
+        ranges = [] if value.lower() == 'off' else parse_time_ranges(value)
+        if chat_id not in targets or not (ranges or value.lower() == 'off'):
+            raise ValueError(value)
+    except:
+        await update.message.reply_text(f"❌ Usage: <code>/{command} -1001234567890 09:00-13:00,18:00-23:00</code> or <code>/{command} ID off</code>", parse_mode=ParseMode.HTML)
+        return
+    await set_target_hours(chat_id, **{kind: ranges})
+    # Workers sleeping until the old opening time re-check now
+    queue_event.set()
+    await update.message.reply_text(
+        f"🕰 <b>{targets[chat_id]}:</b> {describe_target_hours(chat_id).lstrip(' ·') or 'posts any time'}", parse_mode=ParseMode.HTML
+    )
+
+async def window_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await target_hours_command(update, context, 'windows')
+
+async def quiet_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await target_hours_command(update, context, 'quiet')
+
+def describe_target_hours(chat_id):
+    windows, quiet = target_hours.get(chat_id)
+    text = ""
+    if windows:
+        text += f" · posts {format_time_ranges(windows)}"
+    if quiet:
+        text += f" · quiet {format_time_ranges(quiet)}"
+    if text and not target_hours.is_open(chat_id, time.time()):
+        text += " (closed now)"
+    return text
+
 async def link_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id): return
     if not context.args:
@@ -272,9 +2483,11 @@ async def custom_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = " ".join(context.args[1:])
         db_count = -1 if count == 0 else count
         
-        await update_setting('custom_remaining', db_count)
-        await update_setting('custom_text', text)
-        await update_setting('total_off', '0')
+        await update_settings({
+            'custom_remaining': db_count,
+            'custom_text': text,
+            'total_off': '0'
+        })
         
         count_str = "Infinite" if count == 0 else str(count)
         await update.message.reply_text(f"✅ <b>Custom Caption Set!</b>\n\nText: {text}\nVideos: {count_str}", parse_mode=ParseMode.HTML)
@@ -298,15 +2511,51 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cust_text = await get_setting('custom_text')
 
     state = "Paused ⏸" if paused == '1' else "Active ▶️"
+    backlog = await get_target_backlog()
+    now = time.time()
+    target_lines = ""
+    drains = []
+    for chat_id, title in targets.items():
+        rate = rate_limiter.current_rate(chat_id)
+        rate_str = f"{rate * 60:.1f}/min" if rate else "Idle"
+        drain_at = project_drain(chat_id, backlog[chat_id], send_rate_estimate(chat_id), now)
+        drains.append(drain_at)
+        eta = "" if not backlog[chat_id] else f", done ~{format_eta(drain_at, now)}" if drain_at else ", never open"
+        target_lines += f"   • {title} (<code>{chat_id}</code>): {backlog[chat_id]} left, {rate_str}{eta}{describe_target_hours(chat_id)}\n"
+    if paused == '1' or not pending:
+        drain_str = "—"
+    elif None in drains:
+        drain_str = "never (a target has no open hours)"
+    else:
+        drain_str = format_eta(max(drains), now)
+    releases = scheduler.releases()
+    scheduled = sum(count for _, count in releases)
+    quota_str = f" / {quota.max_total}" if quota.max_total else ""
+    if quota.waiting:
+        quota_str += f" (+{quota.spilled()} in overflow)"
     captions = "OFF (Clean) 🧹" if total_off == '1' else "ON 📝"
+    retrying, dead = await get_failure_counts()
+
+    by_hour = {row['hour']: row['sent'] for row in await stats_buffer.throughput(24)}
+    now_hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    recent_keys = [(now_hour - timedelta(hours=h)).strftime("%Y-%m-%d %H:00") for h in range(5, -1, -1)]
+    last_hour = by_hour.get(recent_keys[-1], 0)
+    last_day = sum(by_hour.values())
+    recent = " · ".join(str(by_hour.get(key, 0)) for key in recent_keys)
     
     msg = (
         f"📊 <b>Detailed Info</b>\n"
         f"━━━━━━━━━━━━━━━━━━\n"
         f"⚙️ <b>State:</b> {state}\n"
         f"⏱ <b>Delay:</b> {delay}s\n"
-        f"📥 <b>Queue Pending:</b> {pending}\n"
+        f"📥 <b>Queue Pending:</b> {pending}{quota_str}\n"
+        f"🗓 <b>Scheduled:</b> {scheduled}" + (f" (next {format_eta(releases[0][0], now)})" if releases else "") + "\n"
+        f"⏳ <b>Backlog Drains:</b> {drain_str}\n"
+        f"🎯 <b>Targets:</b>\n{target_lines}"
+        f"🔁 <b>Retrying:</b> {retrying} | 💀 <b>Failed:</b> {dead}\n"
         f"📤 <b>Total Sent (Global):</b> {total_sent_all}\n"
+        f"📈 <b>Throughput:</b> {last_hour} this hour | {last_day} last 24h\n"
+        f"🕐 <b>Last 6 Hours:</b> {recent}\n"
         f"📝 <b>Captions:</b> {captions}\n"
         f"🔗 <b>Join Footer:</b> {'Yes' if join_en=='1' else 'No'}\n"
         f"💬 <b>Custom Queue:</b> {cust_rem} left ({cust_text[:10]}...)"
@@ -317,51 +2566,44 @@ async def infoadmin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id): return
 
     msg_text = "<b>👮 ADMIN INFORMATION DASHBOARD</b>\n\n"
+    if not ADMIN_IDS:
+        await update.message.reply_text(msg_text, parse_mode=ParseMode.HTML)
+        return
+
+    # Normally a no-op: the background refresher keeps the cache warm
+    await admin_profiles.refresh(context.bot, ADMIN_IDS)
+    summary = await get_admin_summary(ADMIN_IDS)
     
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        count = 1
-        for admin_id in ADMIN_IDS:
+    count = 1
+    for admin_id in ADMIN_IDS:
+        name, username = admin_profiles.get(admin_id)
+        row = summary[admin_id]
+        today_count = row['sent_today']
+        total_count = row['sent_lifetime']
+        last_day = row['last_day']
+
+        last_seen_str = "Never"
+        if row['last_sent']:
             try:
-                chat = await context.bot.get_chat(admin_id)
-                name = chat.first_name + (f" {chat.last_name}" if chat.last_name else "")
-                username = f"@{chat.username}" if chat.username else "No Username"
+                utc_dt = datetime.strptime(row['last_sent'], "%Y-%m-%d %H:%M:%S")
+                utc_dt = pytz.utc.localize(utc_dt)
+                local_dt = utc_dt.astimezone(DISPLAY_TZ)
+                last_seen_str = local_dt.strftime("%d-%b-%Y %I:%M %p")
             except:
-                name = "Unknown Admin"
-                username = "Unknown"
-
-            today_count = 0
-            total_count = 0
-            async with db.execute("SELECT sent_today, sent_lifetime FROM stats WHERE user_id = ?", (admin_id,)) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    today_count = row['sent_today']
-                    total_count = row['sent_lifetime']
-
-            last_seen_str = "Never"
-            async with db.execute("SELECT timestamp FROM queue WHERE user_id = ? AND status='sent' ORDER BY id DESC LIMIT 1", (admin_id,)) as cursor:
-                last_q = await cursor.fetchone()
-                if last_q:
-                    try:
-                        utc_dt = datetime.strptime(last_q['timestamp'], "%Y-%m-%d %H:%M:%S")
-                        utc_dt = pytz.utc.localize(utc_dt)
-                        bd_zone = pytz.timezone('Asia/Dhaka')
-                        bd_dt = utc_dt.astimezone(bd_zone)
-                        last_seen_str = bd_dt.strftime("%d-%b-%Y %I:%M %p")
-                    except:
-                        last_seen_str = str(last_q['timestamp'])
-
-            msg_text += (
-                f"<b>👮 Admin {count:02d}</b>\n"
-                f"👤 <b>Display Name :</b> {name}\n"
-                f"💠 <b>Username :</b> {username}\n"
-                f"🆔 <b>Uid :</b> <code>{admin_id}</code>\n"
-                f"🕰 <b>Last Send :</b> {last_seen_str}\n"
-                f"📅 <b>Today Send :</b> {today_count}\n"
-                f"📊 <b>Total Send :</b> {total_count}\n"
-                f"━━━━━━━━━━━━━━━━━━━━\n\n"
-            )
-            count += 1
+                last_seen_str = str(row['last_sent'])
+
+        msg_text += (
+            f"<b>👮 Admin {count:02d}</b>\n"
+            f"👤 <b>Display Name :</b> {name}\n"
+            f"💠 <b>Username :</b> {username}\n"
+            f"🆔 <b>Uid :</b> <code>{admin_id}</code>\n"
+            f"🕰 <b>Last Send :</b> {last_seen_str}\n"
+            f"📅 <b>Today Send :</b> {today_count}\n"
+            f"📊 <b>Total Send :</b> {total_count}\n"
+            f"⚡ <b>Last 24h :</b> {last_day}\n"
+            f"━━━━━━━━━━━━━━━━━━━━\n\n"
+        )
+        count += 1
 
     await update.message.reply_text(msg_text, parse_mode=ParseMode.HTML)
 
@@ -373,13 +2615,28 @@ async def hold_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def resume_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id): return
     await update_setting('paused', '0')
+    queue_event.set()
     await update.message.reply_text("▶️ <b>Forwarding RESUMED.</b>", parse_mode=ParseMode.HTML)
 
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id): return
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("UPDATE queue SET status='cancelled' WHERE status='pending'")
-        await db.commit()
+    await ingest.flush()
+    async with db.transaction() as conn:
+        # Cancelled media may be sent again later, so forget its hashes
+        await conn.execute("""
+            DELETE FROM media_hashes WHERE (user_id, message_id) IN
+            (SELECT user_id, message_id FROM queue WHERE status='pending'
+             UNION ALL SELECT user_id, message_id FROM overflow)
+        """)
+        # Settle their scheduled retries too, or workers would keep waking up for them
+        await conn.execute(
+            "UPDATE deliveries SET status='skipped', next_attempt_at=NULL WHERE status='retry' "
+            "AND queue_id IN (SELECT id FROM queue WHERE status='pending')"
+        )
+        await conn.execute("UPDATE queue SET status='cancelled', finished_at=CURRENT_TIMESTAMP WHERE status='pending'")
+        await conn.execute("DELETE FROM overflow")
+    await load_pending()
+    await dedup.load(int(settings.get('dedup_hours')))
     await update.message.reply_text("🗑 <b>Queue Cleared!</b>", parse_mode=ParseMode.HTML)
 
 # ================= SMART MEDIA HANDLER =================
@@ -397,6 +2654,7 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'text': msg.text,
             'time': datetime.now()
         }
+        timers.schedule(('caption', user_id), CAPTION_WINDOW_SECONDS, expire_caption, user_id)
         # Confirm to admin but DO NOT queue or forward
         await msg.reply_text("📝 <b>Caption Saved!</b> Send media within 5s to apply.", parse_mode=ParseMode.HTML)
         return
@@ -407,153 +2665,434 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif msg.photo: media_type = "Photo"
     elif msg.animation: media_type = "GIF"
     elif msg.document: media_type = "Document"
+
+    # Skip media that was already queued/sent within the dedup window. Each album
+    # item arrives as its own update; the first one decides for the whole album,
+    # so an album is never split into a queued half and a skipped half.
+    file_unique_id = get_file_unique_id(msg)
+    with perf.span('dedup'):
+        duplicate = dedup.is_duplicate(file_unique_id, int(settings.get('dedup_hours')))
+        if msg.media_group_id:
+            if msg.media_group_id not in album_verdicts:
+                album_verdicts[msg.media_group_id] = duplicate
+                timers.schedule(('album', msg.media_group_id), ALBUM_WINDOW_SECONDS, expire_album, msg.media_group_id)
+            duplicate = album_verdicts[msg.media_group_id]
+    if duplicate:
+        # Never forwarded, so its source is cleaned up right away
+        cleanup_queue.add(user_id, [msg.message_id])
+        note_batch(user_id, msg, dupes=1)
+        return
     
-    # Check if a custom caption is waiting (sent < 5 seconds ago)
-    if user_id in pending_captions:
-        saved = pending_captions[user_id]
+    # 3. Add to Database
+    with perf.span('enqueue'):
+        outcome = await add_to_queue(user_id, msg.message_id, media_type, msg.media_group_id, file_unique_id)
+
+    # Check if a custom caption is waiting (sent < 5 seconds ago); the timer
+    # drops unused ones, the age check covers a timer that hasn't run yet.
+    # Only an accepted upload uses it up: a full queue leaves it for the next try.
+    # The row is still buffered, and this write queues for the DB lock before its
+    # flush, so no worker can fetch the row before the caption is set
+    saved = pending_captions.pop(user_id, None) if outcome == 'accepted' else None
+    if saved is not None:
+        timers.cancel(('caption', user_id))
         time_diff = (datetime.now() - saved['time']).total_seconds()
-        
-        # If text was sent recently (e.g., within 5 seconds)
-        if time_diff < 5:
+        if time_diff < CAPTION_WINDOW_SECONDS:
             # Apply settings AUTOMATICALLY (Like /custom 1 Text)
-            await update_setting('custom_text', saved['text'])
-            await update_setting('custom_remaining', '1') # Apply to 1 video
-            await update_setting('total_off', '0') # Ensure captions are ON
-            
-            # Clear the buffer
-            del pending_captions[user_id]
-        else:
-            # Too old, clear it
-            del pending_captions[user_id]
-
-    # 3. Add to Database
-    await add_to_queue(user_id, msg.message_id, media_type)
-    
-    # 4. Batch Notification
-    if user_id in batch_buffer:
-        batch_buffer[user_id]['count'] += 1
-        batch_buffer[user_id]['last_msg'] = msg
-        if batch_buffer[user_id]['task']:
-            batch_buffer[user_id]['task'].cancel()
-    else:
-        batch_buffer[user_id] = {
-            'count': 1,
-            'last_msg': msg,
-            'task': None
-        }
+            await update_settings({
+                'custom_text': saved['text'],
+                'custom_remaining': '1', # Apply to 1 video
+                'total_off': '0' # Ensure captions are ON
+            })
     
-    batch_buffer[user_id]['task'] = asyncio.create_task(send_batch_notification(user_id))
+    # 4. Batch Notification (a full queue is reported right away, once per batch)
+    if outcome == 'accepted':
+        note_batch(user_id, msg, count=1)
+    elif note_batch(user_id, msg, **{outcome: 1})[outcome] == 1:
+        await msg.reply_text(quota_notice(user_id, outcome), parse_mode=ParseMode.HTML)
 
 
 # ================= BACKGROUND WORKER =================
-async def queue_processor(app):
-    logger.info("Queue Processor Started...")
-    batch_counter = 0 
+async def build_progress_report(user_id, batch_counter, delay):
+    today, lifetime = stats_buffer.get(user_id)
+    pending_now, _ = await get_queue_counts()
+    return build_progress_text(
+        sent_batch=batch_counter,
+        total_batch=batch_counter + pending_now, 
+        total_queue=pending_now,
+        today=today,
+        lifetime=lifetime,
+        delay=delay
+    )
+
+async def complete_items(bot, rows):
+    """Finishes acked items: counters, stats, source cleanup and progress."""
+    if not rows:
+        return
+    # Rows cancelled while in flight were already taken off the counters
+    ingest.pending -= len(rows)
+    perf.items += len(rows)
+    for row in rows:
+        scheduler.remove(row['user_id'], row['priority'])
+    # After the removals, so room() no longer counts the rows that just finished
+    if quota.waiting:
+        await quota.promote()
+    by_user = {}
+    for row in rows:
+        by_user.setdefault(row['user_id'], []).append(row)
+    progress.batch_sent += len(rows)
+    delay = int(settings.get('delay'))
+    for user_id, user_rows in by_user.items():
+        delivered = sum(1 for row in user_rows if row['sent'])
+        if delivered:
+            await update_stats(user_id, delivered)
+            items_sent.inc(delivered)
+            recent_sends.append((time.monotonic(), delivered))
+            while recent_sends[0][0] < recent_sends[-1][0] - 60:
+                recent_sends.popleft()
+        # Keep the source of dead letters around so /requeue can still copy it
+        cleanup_queue.add(user_id, [row['message_id'] for row in user_rows if not row['dead']])
+        progress.touch(user_id)
+        if progress.due(user_id):
+            with perf.span('progress'):
+                await progress.publish(bot, user_id, await build_progress_report(user_id, progress.batch_sent, delay))
+
+    if ingest.pending == 0:
+        # Batch finished: push the final numbers, then start fresh next time
+        for admin_id in list(progress.dirty):
+            await progress.publish(bot, admin_id, await build_progress_report(admin_id, progress.batch_sent, delay))
+        progress.finish()
+
+async def send_unit(bot, chat_id, unit):
+    """Copies one post (single item, album or bulk run) to `chat_id`.
+
+    Returns the source message ids copied and, for a captioned album, the copy
+    that still needs the caption (see set_album_caption), else None. copy_messages
+    silently skips source messages that no longer exist and its result doesn't
+    say which ones, so a short bulk copy confirms none of them.
+    """
+    user_id = unit[0]['user_id']
+    caption = unit[0]['caption']
+    msg_ids = [r['message_id'] for r in unit]
+    if len(unit) == 1:
+        await bot.copy_message(
+            chat_id=chat_id,
+            from_chat_id=user_id,
+            message_id=msg_ids[0],
+            caption=caption,
+            parse_mode=ParseMode.HTML,
+            reply_markup=None 
+        )
+        return msg_ids, None
+    # Album grouping is kept by Telegram when copying in bulk; copy_messages
+    # can't set captions, so a captioned album gets it on its first message.
+    result = await bot.copy_messages(
+        chat_id=chat_id,
+        from_chat_id=user_id,
+        message_ids=msg_ids,
+        remove_caption=True
+    )
+    caption_to = result[0].message_id if caption and result else None
+    if len(result) < len(msg_ids):
+        logger.warning(f"Bulk copy to {chat_id} copied {len(result)} of {len(msg_ids)} messages.")
+        return [], caption_to
+    return msg_ids, caption_to
+
+async def set_album_caption(bot, chat_id, message_id, caption, attempt=1):
+    """Adds the caption to an album already posted; a failure never re-sends the album.
+
+    On RetryAfter only the edit is retried later (up to MAX_ATTEMPTS); other
+    errors leave the album without its caption.
+    """
+    try:
+        await bot.edit_message_caption(chat_id=chat_id, message_id=message_id, caption=caption, parse_mode=ParseMode.HTML)
+    except RetryAfter as e:
+        retry_after = retry_after_seconds(e)
+        rate_limiter.on_retry_after(chat_id, retry_after)
+        if attempt < MAX_ATTEMPTS:
+            logger.warning(f"Caption edit in {chat_id} hit the flood limit; retrying in {retry_after}s.")
+            timers.schedule(
+                ('album_caption', chat_id, message_id), retry_after,
+                set_album_caption, bot, chat_id, message_id, caption, attempt + 1
+            )
+        else:
+            logger.error(f"Caption edit in {chat_id} gave up after {attempt} attempts.")
+    except TelegramError as e:
+        logger.error(f"Caption edit in {chat_id} failed: {e}")
+
+async def target_worker(app, chat_id):
+    """Drains the queue into one destination with its own rate budget."""
+    logger.info(f"Target worker started for {chat_id}.")
+    event = queue_event.event(chat_id)
     
-    while True:
+    while chat_id in targets:
+        worker_beats[chat_id] = time.monotonic()
         try:
-            is_paused = await get_setting('paused')
+            event.clear()
+            is_paused = settings.get('paused')
             if is_paused == '1':
-                await asyncio.sleep(2)
+                # Parked until /resume (or new media) sets the event
+                await event.wait()
                 continue
 
-            item = await get_next_item()
-            
-            if not item:
-                if batch_counter > 0: batch_counter = 0
-                await asyncio.sleep(2)
+            now = time.time()
+            opens_at = target_hours.opens_at(chat_id, now)
+            if opens_at is None or opens_at > now:
+                # Quiet hours or outside the posting window: sleep until it opens
+                # (/window and /quiet set the event to re-check)
+                try:
+                    await asyncio.wait_for(event.wait(), opens_at - now if opens_at else None)
+                except asyncio.TimeoutError:
+                    pass
                 continue
 
-            pending_count, _ = await get_queue_counts()
-            if batch_counter == 0: pass 
-            batch_counter += 1
+            with perf.span('fetch'):
+                rows = await get_next_run(chat_id)
             
-            user_id = item['user_id']
-            msg_id = item['message_id']
-            queue_id = item['id']
-            delay = int(await get_setting('delay'))
-            
-            # Caption Building
-            total_off = await get_setting('total_off')
-            final_caption = ""
-            
-            if total_off == '1':
-                final_caption = "" 
-            else:
-                cust_rem = int(await get_setting('custom_remaining'))
-                if cust_rem != 0:
-                    custom_text = await get_setting('custom_text')
-                    final_caption += custom_text + "\n\n"
-                    # Decrease count if it's not infinite (-1)
-                    if cust_rem > 0:
-                        cust_rem -= 1
-                        await update_setting('custom_remaining', cust_rem)
-                
-                join_en = await get_setting('join_enabled')
-                if join_en == '1':
-                    link = await get_setting('link')
-                    final_caption += f"For More Video <a href='{link}'>Join Here</a>"
+            if not rows:
+                # Sleep until the next retry or scheduled item is due; leases held by
+                # a crashed process expire on their own, so look again eventually anyway
+                wake_in = [LEASE_SECONDS, await next_retry_in(chat_id)]
+                for due in (scheduler.next_release(), album_settles.get(chat_id)):
+                    if due is not None:
+                        wake_in.append(max(0, due - time.time()))
+                try:
+                    await asyncio.wait_for(event.wait(), min(w for w in wake_in if w is not None))
+                except asyncio.TimeoutError:
+                    await complete_items(app.bot, await reap_in_doubt())
+                continue
+
+            with perf.span('caption'):
+                rows = await assign_captions(rows)
+            # Bulk runs are kept to the burst so one call can't spend far ahead of the budget
+            unit = next_unit(rows, rate_limiter.burst)
+            queue_ids = [r['id'] for r in unit]
+            delay = int(settings.get('delay'))
+
+            with perf.span('rate_wait'):
+                await rate_limiter.acquire(chat_id, 1 / delay, len(unit))
+            with perf.span('claim'):
+                claimed = await claim_unit(chat_id, queue_ids)
+            if not claimed:
+                # Another worker took it between our read and our claim
+                continue
+            scheduler.charge(chat_id)
 
             try:
-                await app.bot.copy_message(
-                    chat_id=TARGET_GROUP_ID,
-                    from_chat_id=user_id,
-                    message_id=msg_id,
-                    caption=final_caption,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=None 
-                )
-                
-                await update_stats(user_id)
-                await mark_as_sent(queue_id)
-                
-                async with aiosqlite.connect(DB_NAME) as db:
-                    db.row_factory = aiosqlite.Row
-                    async with db.execute("SELECT * FROM stats WHERE user_id = ?", (user_id,)) as cursor:
-                        stat = await cursor.fetchone()
-                
-                pending_now, _ = await get_queue_counts()
-                current_batch_total = batch_counter + pending_now
-
-                report = build_progress_text(
-                    sent_batch=batch_counter,
-                    total_batch=current_batch_total, 
-                    total_queue=pending_now,
-                    today=stat['sent_today'],
-                    lifetime=stat['sent_lifetime'],
-                    delay=delay
-                )
-                
-                try:
-                    await app.bot.send_message(chat_id=user_id, text=report, parse_mode=ParseMode.HTML)
-                except: pass
+                with Timer(send_latency, target=chat_id), perf.span('send'):
+                    copied, caption_to = await send_unit(app.bot, chat_id, unit)
+                rate_limiter.on_success(chat_id)
 
-                try:
-                    await app.bot.delete_message(chat_id=user_id, message_id=msg_id)
-                except: pass
+                # Journal the copy first: whatever the caption edit does, the album is out
+                sent_ids = [r['id'] for r in unit if r['message_id'] in copied]
+                missing = [r['id'] for r in unit if r['message_id'] not in copied]
+                if sent_ids:
+                    with perf.span('record'):
+                        done = await record_deliveries(chat_id, sent_ids, 'sent')
+                    await complete_items(app.bot, done)
+                if missing:
+                    # Deleted sources won't come back, and some of a short bulk run may
+                    # already be posted, so these are dead-lettered rather than retried
+                    send_errors.inc(target=chat_id, outcome='dead')
+                    await complete_items(app.bot, await record_failure(
+                        chat_id, missing, "Not copied (source deleted?); check the target before requeueing", True
+                    ))
+                if caption_to:
+                    await set_album_caption(app.bot, chat_id, caption_to, unit[0]['caption'])
 
             except RetryAfter as e:
-                logger.warning(f"Flood limit exceeded. Sleeping {e.retry_after}s.")
-                await asyncio.sleep(e.retry_after)
+                retry_after = retry_after_seconds(e)
+                logger.warning(f"Flood limit exceeded for {chat_id}. Backing off {retry_after}s.")
+                rate_limiter.on_retry_after(chat_id, retry_after)
+                retry_after_total.inc(target=chat_id)
+                await release_unit(chat_id, queue_ids)
                 continue
             except TelegramError as e:
-                logger.error(f"Telegram Error: {e}")
-                await mark_as_sent(queue_id)
-
-            await asyncio.sleep(delay)
+                # Bad requests (deleted source, bad caption) and lost access won't fix
+                # themselves; anything else (timeouts, network) is retried later. A bulk
+                # run can't tell which message was bad, so its rows retry one by one.
+                bulk = len(album_unit(unit)) < len(unit)
+                permanent = isinstance(e, (BadRequest, Forbidden)) and not bulk
+                logger.error(f"Telegram Error ({chat_id}): {e}")
+                send_errors.inc(target=chat_id, outcome='dead' if permanent else 'retry')
+                await complete_items(app.bot, await record_failure(chat_id, queue_ids, str(e), permanent))
 
         except Exception as e:
-            logger.error(f"Worker Error: {e}")
+            logger.error(f"Worker Error ({chat_id}): {e}")
             await asyncio.sleep(5)
 
+target_tasks = {}
+worker_beats = {}
+
+def start_target_worker(app, chat_id):
+    if chat_id not in target_tasks or target_tasks[chat_id].done():
+        target_tasks[chat_id] = asyncio.create_task(target_worker(app, chat_id))
+
+def stop_target_worker(chat_id):
+    task = target_tasks.pop(chat_id, None)
+    if task:
+        task.cancel()
+    queue_event.events.pop(chat_id, None)
+    worker_beats.pop(chat_id, None)
+
+async def queue_processor(app):
+    """Starts one worker per destination; /addtarget and /removetarget manage them afterwards."""
+    logger.info("Queue Processor Started...")
+    for chat_id in targets:
+        start_target_worker(app, chat_id)
+    rows = recovered_items[:]
+    recovered_items.clear()
+    try:
+        await complete_items(app.bot, rows)
+    except Exception as e:
+        logger.error(f"Recovery Error: {e}")
+
+# ================= WORKER SYNC =================
+async def sync_worker(app, interval):
+    """Picks up changes other processes made to settings, targets and the queue.
+
+    There's no cross-process wakeup, so this also nudges the target workers.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await settings.load()
+            load_urgent_admins()
+            load_publish_times()
+            await load_targets()
+            for chat_id in list(target_tasks):
+                if chat_id not in targets:
+                    stop_target_worker(chat_id)
+            for chat_id in targets:
+                start_target_worker(app, chat_id)
+            await load_pending()
+            await complete_items(app.bot, await reap_in_doubt())
+            queue_event.set()
+        except Exception as e:
+            logger.error(f"Sync Error: {e}")
+
+# ================= HEALTH & METRICS =================
+# (monotonic time, items) per completed batch, for items_per_minute
+recent_sends = deque()
+
+async def get_queue_lag():
+    """Seconds the oldest due item has been waiting since it was queued or came due (0 when none)."""
+    now = time.time()
+    row = await db.fetchone(
+        "SELECT timestamp, publish_at FROM queue WHERE status='pending' AND (publish_at IS NULL OR publish_at <= ?) "
+        "ORDER BY id LIMIT 1", (now,)
+    )
+    if row is None:
+        return 0
+    return max(0, now - max(queued_at(row['timestamp']), row['publish_at'] or 0))
+
+@metrics.collector
+async def collect_metrics():
+    now = time.monotonic()
+    while recent_sends and recent_sends[0][0] < now - 60:
+        recent_sends.popleft()
+    items_per_minute.set(sum(n for _, n in recent_sends))
+    queue_depth.set(ingest.pending)
+    overflow_depth.set(quota.spilled())
+    queue_lag.set(round(await get_queue_lag(), 1))
+    retrying, dead = await get_failure_counts()
+    retrying_gauge.set(retrying)
+    dead_letters_gauge.set(dead)
+    heartbeat_age.clear()
+    for chat_id, beat in worker_beats.items():
+        heartbeat_age.set(round(now - beat, 1), target=chat_id)
+
+async def check_health():
+    """Unhealthy when a target worker died or stalled with work pending, or the backlog is too old."""
+    now = time.monotonic()
+    paused = settings.get('paused') == '1'
+    allowance = HEALTH_STALL_SECONDS + int(settings.get('delay'))
+    problems = []
+    workers = {}
+    # Scheduled items and closed targets are supposed to sit still
+    due = ingest.pending - sum(count for _, count in scheduler.releases())
+    for chat_id in targets:
+        task = target_tasks.get(chat_id)
+        # A worker sitting out a flood wait or a bucket's debt isn't stalled; its
+        # allowance starts once the limiter lets it send again
+        age = now - max(worker_beats.get(chat_id, now), min(rate_limiter.ready_at(chat_id), now))
+        workers[str(chat_id)] = round(age, 1)
+        if task is None or task.done():
+            problems.append(f"worker for {chat_id} is not running")
+        elif due > 0 and not paused and target_hours.is_open(chat_id, time.time()) and age > allowance:
+            problems.append(f"worker for {chat_id} stalled for {age:.0f}s")
+    lag = await get_queue_lag()
+    if MAX_QUEUE_LAG and not paused and lag > MAX_QUEUE_LAG:
+        problems.append(f"oldest item waited {lag:.0f}s")
+    details = {
+        'status': 'ok' if not problems else 'unhealthy',
+        'problems': problems,
+        'paused': paused,
+        'pending': ingest.pending,
+        'lag_seconds': round(lag, 1),
+        'heartbeat_age_seconds': workers,
+    }
+    return not problems, details
+
+# ================= STATS FLUSH =================
+async def stats_flush_worker():
+    while True:
+        await asyncio.sleep(STATS_FLUSH_INTERVAL)
+        await stats_buffer.flush()
+
+# ================= RETENTION =================
+async def archive_finished_rows(older_than_hours, chunk=5000):
+    """Moves sent/failed/cancelled rows into queue_archive in small transactions. Returns rows moved."""
+    moved = 0
+    while True:
+        async with db.transaction() as conn:
+            # Rows finished before finished_at existed fall back to their enqueue time. No
+            # ORDER BY: sorting every finished row per chunk made this quadratic.
+            async with conn.execute(
+                "SELECT id FROM queue WHERE status IN ('sent', 'failed', 'cancelled') "
+                "AND COALESCE(finished_at, timestamp) < datetime('now', ?) LIMIT ?",
+                (f"-{older_than_hours} hours", chunk)
+            ) as cursor:
+                ids = [(row[0],) for row in await cursor.fetchall()]
+            if not ids:
+                return moved
+            await conn.executemany("""
+                INSERT OR REPLACE INTO queue_archive (id, user_id, message_id, media_type, status, timestamp, media_group_id, finished_at)
+                SELECT id, user_id, message_id, media_type, status, timestamp, media_group_id, finished_at FROM queue WHERE id = ?
+            """, ids)
+            await conn.executemany("DELETE FROM queue WHERE id = ?", ids)
+            await conn.executemany("DELETE FROM deliveries WHERE queue_id = ?", ids)
+        moved += len(ids)
+        # Let handlers and the worker get at the connection between chunks
+        await asyncio.sleep(0)
+
+async def retention_worker():
+    while True:
+        try:
+            await asyncio.sleep(ARCHIVE_INTERVAL)
+            await dedup.prune(int(settings.get('dedup_hours')))
+            moved = await archive_finished_rows(ARCHIVE_AFTER_HOURS)
+            if moved:
+                async with db.lock:
+                    # Each result row is one freed page, so the cursor must be drained
+                    async with db.conn.execute("PRAGMA incremental_vacuum") as cursor:
+                        await cursor.fetchall()
+                logger.info(f"Archived {moved} finished queue rows.")
+        except Exception as e:
+            logger.error(f"Retention Error: {e}")
+
 # ================= MAIN =================
-if __name__ == "__main__":
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(init_db())
+async def shutdown(app):
+    await ingest.flush()
+    await stats_buffer.flush()
+    await db.close()
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+def build_application():
+    builder = ApplicationBuilder().token(BOT_TOKEN)
+    if BOT_API_URL:
+        builder = builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+    return builder
 
+def add_handlers(app):
     app.add_handler(CommandHandler("start", start_command))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("delay", delay_command))
@@ -562,6 +3101,17 @@ if __name__ == "__main__":
     app.add_handler(CommandHandler("cancel", cancel_command))
     app.add_handler(CommandHandler("info", info_command))
     app.add_handler(CommandHandler("infoadmin", infoadmin_command))
+    app.add_handler(CommandHandler("dedup", dedup_command))
+    app.add_handler(CommandHandler("urgent", urgent_command))
+    app.add_handler(CommandHandler("targets", targets_command))
+    app.add_handler(CommandHandler("addtarget", addtarget_command))
+    app.add_handler(CommandHandler("removetarget", removetarget_command))
+    app.add_handler(CommandHandler("window", window_command))
+    app.add_handler(CommandHandler("quiet", quiet_command))
+    app.add_handler(CommandHandler("at", at_command))
+    app.add_handler(CommandHandler("failed", failed_command))
+    app.add_handler(CommandHandler("requeue", requeue_command))
+    app.add_handler(CommandHandler("perf", perf_command))
     
     app.add_handler(CommandHandler("link", link_command))
     app.add_handler(CommandHandler("joinshow", joinshow_command))
@@ -572,7 +3122,96 @@ if __name__ == "__main__":
 
     app.add_handler(MessageHandler(filters.ChatType.PRIVATE & ~filters.COMMAND, handle_media))
 
+def start_background_tasks(loop, app):
     loop.create_task(queue_processor(app))
+    loop.create_task(cleanup_queue.run(app.bot))
+    loop.create_task(retention_worker())
+    loop.create_task(stats_flush_worker())
+    loop.create_task(admin_profiles.run(app.bot, ADMIN_IDS))
+    loop.create_task(timers.run())
+    if SYNC_INTERVAL:
+        loop.create_task(sync_worker(app, SYNC_INTERVAL))
+
+# Admins' updates are handled one at a time, in order (a caption text must land
+# before the media it applies to); different chats run concurrently
+admin_update_locks = {}
+
+async def dispatch_update(app, payload):
+    update = Update.de_json(payload, app.bot)
+    user = update.effective_user
+    if user is None or not is_admin(user.id):
+        await app.process_update(update)
+        return
+    lock = admin_update_locks.setdefault(user.id, asyncio.Lock())
+    async with lock:
+        await app.process_update(update)
+
+async def run_webhook():
+    """Webhook mode: Telegram POSTs updates to our HTTP server on this event loop."""
+    await init_db()
+    app = build_application().build()
+    add_handlers(app)
+    async with app:
+        await app.start()
+        start_background_tasks(asyncio.get_running_loop(), app)
+        receive = webhook_route(WEBHOOK_SECRET, lambda payload: dispatch_update(app, payload), WEBHOOK_MAX_INFLIGHT)
+        runner = await start_server(PORT, metrics, check_health, webhooks=[(WEBHOOK_PATH, receive)])
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=min(100, WEBHOOK_MAX_INFLIGHT),
+                allowed_updates=Update.ALL_TYPES
+            )
+        print("Bot is running (webhook)...")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+            await app.stop()
+            await shutdown(app)
+
+async def run_worker():
+    """Headless mode: only drains the shared queue (no polling, no commands)."""
+    await init_db()
+    app = build_application().build()
+    async with app:
+        tasks = [
+            asyncio.create_task(queue_processor(app)),
+            asyncio.create_task(cleanup_queue.run(app.bot)),
+            asyncio.create_task(stats_flush_worker()),
+            asyncio.create_task(sync_worker(app, SYNC_INTERVAL or 2)),
+        ]
+        if WORKER_PORT:
+            await start_server(WORKER_PORT, metrics, check_health)
+        print(f"Worker {WORKER_ID} is running...")
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await shutdown(app)
+
+if __name__ == "__main__":
+    if "--worker" in sys.argv:
+        asyncio.run(run_worker())
+        sys.exit(0)
+    if UPDATE_MODE == "webhook":
+        try:
+            asyncio.run(run_webhook())
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(init_db())
+
+    app = build_application().post_shutdown(shutdown).build()
+    add_handlers(app)
+    start_background_tasks(loop, app)
+    if PORT:
+        loop.run_until_complete(start_server(PORT, metrics, check_health))
 
     print("Bot is running...")
     app.run_polling()
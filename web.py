@@ -1,17 +1,202 @@
-from flask import Flask
-from threading import Thread
-import os
+"""Health, metrics and webhook endpoints, served on the bot's own event loop."""
+import asyncio
+import hmac
+import logging
+import time
+from aiohttp import web
 
-app = Flask('')
+logger = logging.getLogger(__name__)
 
-@app.route('/')
-def home():
-    return "I am alive!"
 
-def run():
-    port = int(os.environ.get("PORT", 8080))
-    app.run(host='0.0.0.0', port=port)
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    inner = ",".join(f'{key}="{str(value)}"' for key, value in pairs)
+    return "{" + inner + "}"
 
-def keep_alive():
-    t = Thread(target=run)
-    t.start()
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = {}
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        return self.header() + [f"{self.name}{format_labels(key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def clear(self):
+        self.values.clear()
+
+    def render(self):
+        return self.header() + [f"{self.name}{format_labels(key)} {value}" for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.values.get(key)
+        if series is None:
+            # Per-bucket counts (made cumulative when rendered), then sum and count
+            series = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = self.header()
+        for key, (counts, total, count) in self.values.items():
+            running = 0
+            for bound, n in zip(self.buckets, counts):
+                running += n
+                lines.append(f"{self.name}_bucket{format_labels(key, [('le', bound)])} {running}")
+            lines.append(f"{self.name}_bucket{format_labels(key, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Holds the metrics and the async collectors that refresh gauges on each scrape."""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text):
+        return self.add(Counter(name, help_text))
+
+    def gauge(self, name, help_text):
+        return self.add(Gauge(name, help_text))
+
+    def histogram(self, name, help_text, buckets):
+        return self.add(Histogram(name, help_text, buckets))
+
+    def collector(self, func):
+        self.collectors.append(func)
+        return func
+
+    async def collect(self):
+        for func in self.collectors:
+            await func()
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class Timer:
+    """`with Timer(histogram, op='x'):` observes the block's duration in seconds."""
+
+    def __init__(self, histogram, **labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+def webhook_route(secret, handle, max_inflight):
+    """aiohttp handler for Telegram webhook POSTs.
+
+    Checks the secret-token header, answers right away and runs `handle(payload)`
+    in the background. At most `max_inflight` run at once; past that the request
+    waits for a slot, which holds Telegram's connection and slows its delivery.
+    """
+    slots = asyncio.Semaphore(max_inflight)
+    running = set()
+
+    async def run(payload):
+        try:
+            await handle(payload)
+        except Exception as e:
+            logger.error(f"Webhook update failed: {e}")
+        finally:
+            slots.release()
+
+    async def receive(request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, secret):
+            return web.Response(status=403)
+        try:
+            payload = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await slots.acquire()
+        task = asyncio.create_task(run(payload))
+        running.add(task)
+        task.add_done_callback(running.discard)
+        return web.Response()
+
+    return receive
+
+
+async def start_server(port, registry, health, webhooks=()):
+    """Serves /, /healthz, /metrics and any (path, handler) webhook POST routes.
+
+    `health` is an async callable returning (ok, details).
+    """
+
+    async def home(request):
+        return web.Response(text="I am alive!")
+
+    async def healthz(request):
+        ok, details = await health()
+        return web.json_response(details, status=200 if ok else 503)
+
+    async def metrics(request):
+        await registry.collect()
+        return web.Response(
+            body=registry.render().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
+
+    app = web.Application()
+    app.router.add_get("/", home)
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/metrics", metrics)
+    for path, handler in webhooks:
+        app.router.add_post(path, handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    return runner